@@ -0,0 +1,313 @@
+"""Headless benchmarks of the hot paths of the plugin.
+
+The plugin modules are imported with the stand-in sublime and
+sublime_plugin modules of this directory, and run on generated documents.
+For every benchmark and document size, the best time among a few runs is
+reported, together with the number of view API calls of one run (each of
+them being a round trip to the plugin host in the real editor).
+
+Usage:
+    python benchmarks/bench.py [--lines 1000 10000 100000] [--repeat 3]
+                               [--only find_headline fold_all ...]
+"""
+# LICENSE: MIT
+
+import argparse
+import importlib
+import os
+import random
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCH_DIR)
+PACKAGE = os.path.basename(PACKAGE_DIR)
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+
+import sublime  # noqa: E402 (the stand-in of this directory)
+
+
+def load(module):
+    """Import a module of the plugin, as a package the way Sublime Text does.
+    """
+    return importlib.import_module(PACKAGE + "." + module)
+
+
+headline = load("headline")
+smart_folding = load("smart_folding")
+smart_list = load("smart_list")
+smart_table = load("smart_table")
+table = load("table")
+
+# As Sublime Text would register the event listeners of the plugin.
+sublime.LISTENERS.append(headline.OutlineListener())
+sublime.LISTENERS.append(smart_table.SmartTableListener())
+
+
+# -- Documents ------------------------------------------------------------
+
+def make_document(lines, seed=0):
+    """Generate a Markdown document of about lines lines.
+
+    It has nested headlines, paragraphs, lists, small grid tables and
+    fenced code blocks full of '# comment' lines.
+    """
+    rnd = random.Random(seed)
+    out = []
+    section = 0
+    while len(out) < lines:
+        section += 1
+        out.append("#" * rnd.randint(1, 4) + " Section %d" % section)
+        out.append("")
+        kind = rnd.random()
+        if kind < 0.1:
+            out.append("```sh")
+            for i in range(rnd.randint(5, 30)):
+                out.append("# comment %d" % i)
+                out.append("echo %d" % i)
+            out.append("```")
+        elif kind < 0.2:
+            out.append("+-----+-----+")
+            for i in range(rnd.randint(2, 6)):
+                out.append("| a%d | b%d |" % (i, i))
+            out.append("+-----+-----+")
+        elif kind < 0.4:
+            for i in range(rnd.randint(2, 8)):
+                out.append("- item %d" % i)
+        else:
+            for i in range(rnd.randint(2, 10)):
+                out.append("Some text of section %d, line %d." % (section, i))
+        out.append("")
+    return "\n".join(out[:lines]) + "\n"
+
+
+def make_table_rows(rows, cols=8, seed=0):
+    """Generate the lines of a misaligned grid table."""
+    rnd = random.Random(seed)
+    out = ["+" + "-" * 10 + "+",
+           "| " + " | ".join("header %d" % c for c in range(cols)) + " |",
+           "+=" + "=" * 10 + "+"]
+    for r in range(rows):
+        cells = ["x" * rnd.randint(0, 12) for _ in range(cols)]
+        out.append("|" + "|".join(cells) + "|")
+    out.append("+-")
+    return out
+
+
+def make_table_document(lines):
+    """Generate a document mostly made of one big grid table."""
+    head = make_document(max(lines // 10, 10)).splitlines()
+    rows = make_table_rows(max(lines - len(head) - 4, 1))
+    return "\n".join(head + [""] + rows + ["", "The end."]) + "\n", len(head) + 1
+
+
+# -- Benchmarks -----------------------------------------------------------
+
+class Benchmark(object):
+    """A benchmark: setup(lines) returns the state passed to run."""
+    def __init__(self, name, setup, run):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+
+def _view_with_cursor(text, point):
+    view = sublime.View(text)
+    view.sel().add(sublime.Region(point, point))
+    return view
+
+
+def setup_find_headline(lines):
+    text = make_document(lines)
+    rnd = random.Random(lines)
+    points = [rnd.randint(0, len(text)) for _ in range(200)]
+    return sublime.View(text), points
+
+
+def setup_find_headline_indexed(lines):
+    view, points = setup_find_headline(lines)
+    headline.region_of_content_of_headline_at_point(view, 0)
+    return view, points
+
+
+def run_find_headline(state):
+    view, points = state
+    for i, point in enumerate(points):
+        headline.find_headline(view, point, headline.ANY_LEVEL, i % 2 == 0,
+                               skip_headline_at_point=True, skip_folded=True)
+
+
+def setup_fold_all(lines):
+    return smart_folding.GlobalFoldingCommand(
+        _view_with_cursor(make_document(lines), 0))
+
+
+def run_fold_all(command):
+    command.fold_all()
+
+
+def setup_is_global_folded(lines):
+    command = setup_fold_all(lines)
+    command.fold_all()
+    return command
+
+
+def run_is_global_folded(command):
+    command.is_global_folded()
+
+
+def setup_smart_table(lines):
+    text, first_row = make_table_document(lines)
+    view = sublime.View(text)
+    point = view.text_point(first_row + 4, 1)
+    view.sel().add(sublime.Region(point, point))
+    return smart_table.SmartTable(view)
+
+
+def setup_smart_table_small(lines):
+    # A small table near the end of a big document.
+    text = make_document(lines)
+    view = sublime.View(text)
+    point = text.rfind("| a0 |") + 1
+    view.sel().add(sublime.Region(point, point))
+    return smart_table.SmartTable(view)
+
+
+def run_smart_table(command):
+    command.run(sublime.Edit())
+
+
+def setup_smart_table_lazy(lines):
+    # Realign the tables left dirty by the previous runs.
+    sublime.run_timeouts()
+    return setup_smart_table(lines)
+
+
+def run_smart_table_lazy(command):
+    settings = sublime.load_settings(smart_table.SETTINGS_FILE)
+    settings.set("smart_table_lazy_align", True)
+    try:
+        for _ in range(20):
+            command.run(sublime.Edit())
+    finally:
+        settings.set("smart_table_lazy_align", False)
+
+
+def setup_sort_table(lines):
+    return smart_table.SmartTableSortCommand(setup_smart_table(lines).view)
+
+
+def setup_align_all(lines):
+    return smart_table.SmartTableAlignAllCommand(
+        _view_with_cursor(make_document(lines), 0))
+
+
+def run_align_all(command):
+    command.run(sublime.Edit())
+    # Big views are aligned in a background thread.
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    sublime.run_timeouts()
+
+
+def setup_reformat_table_list(lines):
+    return [table._convert_row_text_as_list(row)
+            for row in make_table_rows(lines)]
+
+
+def setup_reformat_wide_table_list(lines):
+    return [table._convert_row_text_as_list(row)
+            for row in make_table_rows(lines, cols=50)]
+
+
+def run_reformat_table_list(table_list):
+    table.convert_table_list_to_str(table.reformat_table_list(table_list))
+
+
+def setup_smart_list(lines):
+    text = make_document(lines)
+    view = sublime.View(text)
+    points = [m for m in range(len(text)) if text.startswith("- item", m)]
+    for point in points[:100]:
+        end = view.line(point).b
+        view.sel().add(sublime.Region(end, end))
+    return smart_list.SmartListCommand(view)
+
+
+def run_smart_list(command):
+    command.run(sublime.Edit())
+
+
+BENCHMARKS = [
+    Benchmark("find_headline", setup_find_headline, run_find_headline),
+    Benchmark("find_headline_indexed", setup_find_headline_indexed,
+              run_find_headline),
+    Benchmark("fold_all", setup_fold_all, run_fold_all),
+    Benchmark("is_global_folded", setup_is_global_folded,
+              run_is_global_folded),
+    Benchmark("smart_table", setup_smart_table, run_smart_table),
+    Benchmark("smart_table_small", setup_smart_table_small,
+              run_smart_table),
+    Benchmark("smart_table_lazy", setup_smart_table_lazy,
+              run_smart_table_lazy),
+    Benchmark("sort_table", setup_sort_table, run_smart_table),
+    Benchmark("align_all", setup_align_all, run_align_all),
+    Benchmark("reformat_table_list", setup_reformat_table_list,
+              run_reformat_table_list),
+    Benchmark("reformat_wide_table_list", setup_reformat_wide_table_list,
+              run_reformat_table_list),
+    Benchmark("smart_list", setup_smart_list, run_smart_list),
+]
+
+
+def measure(benchmark, lines, repeat):
+    """Return the best time (in seconds) and the API calls of one run."""
+    best = None
+    calls = None
+    for _ in range(repeat):
+        state = benchmark.setup(lines)
+        sublime.reset_calls()
+        start = time.perf_counter()
+        benchmark.run(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        calls = dict(sublime.CALLS)
+    return best, calls
+
+
+def format_calls(calls, top=4):
+    total = sum(calls.values())
+    most = sorted(calls.items(), key=lambda item: -item[1])[:top]
+    return "%d (%s)" % (total, ", ".join("%s %d" % item for item in most))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="sizes of the generated documents")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per benchmark, the best one is reported")
+    parser.add_argument("--only", nargs="+", default=None,
+                        help="names of the benchmarks to run")
+    args = parser.parse_args(argv)
+
+    print("%-24s %8s %12s  %s" % ("benchmark", "lines", "best (ms)",
+                                  "view API calls"))
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.name not in args.only:
+            continue
+        for lines in args.lines:
+            best, calls = measure(benchmark, lines, args.repeat)
+            print("%-24s %8d %12.2f  %s" % (benchmark.name, lines,
+                                            best * 1000, format_calls(calls)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
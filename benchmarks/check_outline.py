@@ -0,0 +1,115 @@
+"""Headless check of the incremental headline outline.
+
+Random edits are made on generated documents, the way the editor would run
+them (typing, deleting, smart_list, change_heading_level, and modifications
+made outside of any command). After every few of them, the outline patched
+by OutlineListener has to be the same as an outline rebuilt from scratch.
+
+Usage:
+    python benchmarks/check_outline.py [--lines 300] [--edits 2000]
+                                       [--seed 0]
+"""
+# LICENSE: MIT
+
+import argparse
+import random
+import sys
+
+from bench import headline, load, make_document, sublime
+
+# For view.run_command("change_heading_level").
+load("headline_level")
+
+# Characters typed by the insert commands, with the ones making or breaking
+# headlines and fences over-represented.
+TYPED = ["#", "#", " ", "\n", "\n", "`", "```", "~~~", "x", "# h", "\n# h\n"]
+
+
+def outline_arrays(outline):
+    return (list(outline.starts), list(outline.ends), list(outline.levels),
+            list(outline.code_starts), list(outline.code_ends))
+
+
+def set_cursors(view, rnd):
+    size = view.size()
+    view.sel().clear()
+    for point in sorted(rnd.sample(range(size + 1), rnd.randint(1, 3))):
+        view.sel().add(sublime.Region(point, point))
+
+
+def edit(view, rnd):
+    """Make one random edit of view, return its description."""
+    set_cursors(view, rnd)
+    kind = rnd.random()
+    if kind < 0.45:
+        args = {"characters": rnd.choice(TYPED)}
+        view.run_command("insert", args)
+        return "insert %r" % args["characters"]
+    elif kind < 0.6:
+        view.run_command("left_delete")
+        return "left_delete"
+    elif kind < 0.7:
+        view.run_command("right_delete")
+        return "right_delete"
+    elif kind < 0.8:
+        view.run_command("smart_list")
+        return "smart_list"
+    elif kind < 0.9 and len(view.sel()) == 1 and \
+            view.line(view.sel()[0]).size():
+        # (change_heading_level handles one cursor on a non empty line.)
+        args = {"up": rnd.random() < 0.5}
+        view.run_command("change_heading_level", args)
+        return "change_heading_level %r" % args["up"]
+    elif kind < 0.9:
+        return "nothing"
+    # A modification no command accounts for, away from the cursors (as
+    # after an undo or a reload).
+    a = rnd.randint(0, view.size())
+    b = min(a + rnd.randint(0, 40), view.size())
+    view.replace(sublime.Edit(), sublime.Region(a, b), rnd.choice(TYPED))
+    return "replace (%d, %d)" % (a, b)
+
+
+def check(lines, edits, seed):
+    """Return the number of mismatches found."""
+    rnd = random.Random(seed)
+    view = sublime.View(make_document(lines, seed))
+    headline._get_outline(view)
+    done = []
+    failures = 0
+    for _ in range(edits):
+        done.append(edit(view, rnd))
+        if rnd.random() < 0.5:
+            continue
+        patched = outline_arrays(headline._get_outline(view))
+        rebuilt = outline_arrays(headline._build_outline(view))
+        if patched != rebuilt:
+            failures += 1
+            print("mismatch after: %s" % ", ".join(done[-5:]))
+            # Start again from a good outline.
+            headline._outlines.pop(view.id(), None)
+        done = []
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, default=300,
+                        help="size of the generated documents")
+    parser.add_argument("--edits", type=int, default=2000,
+                        help="random edits per document")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first document")
+    parser.add_argument("--documents", type=int, default=5,
+                        help="number of documents to check")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    for seed in range(args.seed, args.seed + args.documents):
+        failures += check(args.lines, args.edits, seed)
+    print("%d mismatch(es)" % failures)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
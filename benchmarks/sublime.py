@@ -0,0 +1,501 @@
+"""A stand-in for the sublime module, for running the plugin outside of
+Sublime Text.
+
+Only the parts of the API used by the plugin are provided, backed by an
+in-memory string. Every call to a View method is counted in CALLS, since
+each of them is a round trip to the plugin host in the real editor.
+
+Regular expressions are run by Python's re rather than by the Boost engine
+of Sublime Text, and scopes are made up: a line is "markup.heading" if it
+starts with #s and isn't inside a fenced code block.
+"""
+# LICENSE: MIT
+
+import re
+import bisect
+import collections
+
+CALLS = collections.Counter()
+
+HIDDEN = 128
+
+_NEWLINE = re.compile(r'\n')
+_FENCE_OR_HEADLINE = re.compile(r'^(?:[ ]{0,3}(`{3,}|~{3,})|#+\s)', re.M)
+
+
+def reset_calls():
+    CALLS.clear()
+
+
+def _counted(method):
+    name = method.__name__
+
+    def wrapper(self, *args, **kwargs):
+        CALLS[name] += 1
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class Region(object):
+    __slots__ = ('a', 'b', 'xpos')
+
+    def __init__(self, a, b=None, xpos=-1):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+        self.xpos = xpos
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()),
+                      max(self.end(), other.end()))
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and \
+            (self.a, self.b) == (other.a, other.b)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __len__(self):
+        return self.size()
+
+    def __repr__(self):
+        return "(%d, %d)" % (self.a, self.b)
+
+
+class Selection(object):
+    def __init__(self):
+        self._regions = []
+
+    def clear(self):
+        self._regions = []
+
+    def add(self, region):
+        if not isinstance(region, Region):
+            region = Region(region)
+        self._regions.append(region)
+        self._regions.sort(key=Region.begin)
+
+    def __iter__(self):
+        return iter(list(self._regions))
+
+    def __getitem__(self, index):
+        return self._regions[index]
+
+    def __len__(self):
+        return len(self._regions)
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._callbacks = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def has(self, key):
+        return key in self._values
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def erase(self, key):
+        self._values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self._callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self._callbacks.pop(tag, None)
+
+
+class Edit(object):
+    pass
+
+
+class View(object):
+    _next_id = 1
+
+    def __init__(self, text="", file_name=None):
+        self._text = text
+        self._id = View._next_id
+        View._next_id += 1
+        self._file_name = file_name
+        self._change_count = 0
+        self._sel = Selection()
+        self._folds = []
+        self._regions = {}
+        self._status = {}
+        self._settings = Settings()
+        self._line_starts = None
+        self._headline_lines = None
+
+    # The cached line starts and scopes are dropped on every modification.
+    def _get_line_starts(self):
+        if self._line_starts is None:
+            self._line_starts = [0] + [m.end() for m in
+                                       _NEWLINE.finditer(self._text)]
+        return self._line_starts
+
+    def _get_headline_lines(self):
+        if self._headline_lines is None:
+            lines = set()
+            fence = None
+            for match in _FENCE_OR_HEADLINE.finditer(self._text):
+                marker = match.group(1)
+                if marker is None:
+                    if fence is None:
+                        lines.add(match.start())
+                elif fence is None:
+                    fence = marker
+                elif marker[0] == fence[0] and len(marker) >= len(fence):
+                    fence = None
+            self._headline_lines = lines
+        return self._headline_lines
+
+    def _line_region(self, point):
+        point = max(0, min(point, len(self._text)))
+        a = self._text.rfind('\n', 0, point) + 1
+        b = self._text.find('\n', point)
+        if b == -1:
+            b = len(self._text)
+        return Region(a, b)
+
+    def _modify(self, a, b, text):
+        self._text = self._text[:a] + text + self._text[b:]
+        self._line_starts = None
+        self._headline_lines = None
+        self._change_count += 1
+        delta = len(text) - (b - a)
+
+        def move(point, stick_right):
+            if point < a or (point == a and not stick_right):
+                return point
+            elif point >= b:
+                return point + delta
+            return a + len(text) if stick_right else a
+
+        self._sel._regions = [Region(move(r.a, True), move(r.b, True))
+                              for r in self._sel._regions]
+        self._folds = [Region(move(f.a, False), move(f.b, False))
+                       for f in self._folds
+                       if not (f.begin() < b and a < f.end())]
+        for key, regions in self._regions.items():
+            self._regions[key] = [Region(move(r.a, False), move(r.b, True))
+                                  for r in regions]
+        for listener in LISTENERS:
+            if hasattr(listener, "on_modified"):
+                listener.on_modified(self)
+
+    # -- Buffer --------------------------------------------------------
+    @_counted
+    def id(self):
+        return self._id
+
+    @_counted
+    def buffer_id(self):
+        return self._id
+
+    @_counted
+    def size(self):
+        return len(self._text)
+
+    @_counted
+    def change_count(self):
+        return self._change_count
+
+    @_counted
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self._text[x.begin():x.end()]
+        return self._text[x] if 0 <= x < len(self._text) else '\x00'
+
+    @_counted
+    def find(self, pattern, start_point, flags=0):
+        match = re.compile(pattern, re.M).search(self._text, start_point)
+        if match is None:
+            return Region(-1, -1)
+        return Region(match.start(), match.end())
+
+    @_counted
+    def find_all(self, pattern, flags=0):
+        return [Region(m.start(), m.end())
+                for m in re.finditer(pattern, self._text, re.M)]
+
+    @_counted
+    def line(self, x):
+        if isinstance(x, Region):
+            return Region(self._line_region(x.begin()).a,
+                          self._line_region(x.end()).b)
+        return self._line_region(x)
+
+    @_counted
+    def full_line(self, x):
+        point = x.end() if isinstance(x, Region) else x
+        region = self._line_region(point)
+        if isinstance(x, Region):
+            region = Region(self._line_region(x.begin()).a, region.b)
+        if region.b < len(self._text):
+            return Region(region.a, region.b + 1)
+        return region
+
+    @_counted
+    def lines(self, region):
+        regions = []
+        point = region.begin()
+        while True:
+            line = self._line_region(point)
+            regions.append(line)
+            if line.b >= region.end() or line.b >= len(self._text):
+                return regions
+            point = line.b + 1
+
+    @_counted
+    def rowcol(self, point):
+        point = max(0, min(point, len(self._text)))
+        starts = self._get_line_starts()
+        row = bisect.bisect_right(starts, point) - 1
+        return (row, point - starts[row])
+
+    @_counted
+    def text_point(self, row, col):
+        starts = self._get_line_starts()
+        if row < 0:
+            return 0
+        if row >= len(starts):
+            return len(self._text)
+        return min(starts[row] + col, len(self._text))
+
+    @_counted
+    def score_selector(self, point, selector):
+        if selector.startswith("text.html.markdown"):
+            return 1
+        if selector.startswith("markup.heading"):
+            line = self._line_region(point)
+            return 1 if line.a in self._get_headline_lines() else 0
+        return 0
+
+    @_counted
+    def insert(self, edit, point, text):
+        self._modify(point, point, text)
+        return len(text)
+
+    @_counted
+    def erase(self, edit, region):
+        self._modify(region.begin(), region.end(), "")
+
+    @_counted
+    def replace(self, edit, region, text):
+        self._modify(region.begin(), region.end(), text)
+
+    # -- Folding -------------------------------------------------------
+    @_counted
+    def folded_regions(self):
+        return list(self._folds)
+
+    @_counted
+    def fold(self, x):
+        regions = x if isinstance(x, list) else [x]
+        regions = [Region(r.begin(), r.end()) for r in regions if not r.empty()]
+        if not regions:
+            return False
+        merged = []
+        for region in sorted(self._folds + regions, key=Region.begin):
+            if merged and region.begin() < merged[-1].end():
+                merged[-1] = merged[-1].cover(region)
+            else:
+                merged.append(region)
+        changed = merged != self._folds
+        self._folds = merged
+        return changed
+
+    @_counted
+    def unfold(self, x):
+        regions = x if isinstance(x, list) else [x]
+        unfolded = []
+        for region in regions:
+            kept = []
+            for fold in self._folds:
+                if fold.intersects(region) or region.contains(fold):
+                    unfolded.append(fold)
+                else:
+                    kept.append(fold)
+            self._folds = kept
+        return unfolded
+
+    # -- Everything else -----------------------------------------------
+    @_counted
+    def sel(self):
+        return self._sel
+
+    @_counted
+    def file_name(self):
+        return self._file_name
+
+    @_counted
+    def encoding(self):
+        return 'UTF-8'
+
+    @_counted
+    def settings(self):
+        return self._settings
+
+    def show(self, x, *args, **kwargs):
+        pass
+
+    def show_at_center(self, x):
+        pass
+
+    def set_status(self, key, value):
+        self._status[key] = value
+
+    def erase_status(self, key):
+        self._status.pop(key, None)
+
+    def add_regions(self, key, regions, *args, **kwargs):
+        self._regions[key] = sorted(regions, key=Region.begin)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def is_loading(self):
+        return False
+
+    def window(self):
+        return None
+
+    def run_command(self, name, args=None):
+        """Run a command of the plugin or a built-in editing command.
+
+        The event listeners are told about it as by Sublime Text.
+        """
+        import sublime_plugin
+        for listener in LISTENERS:
+            if hasattr(listener, "on_text_command"):
+                listener.on_text_command(self, name, args)
+        try:
+            if name in _BUILTIN_COMMANDS:
+                _BUILTIN_COMMANDS[name](self, **(args or {}))
+            else:
+                command = sublime_plugin.find_command(name)(self)
+                command.run(Edit(), **(args or {}))
+        finally:
+            for listener in LISTENERS:
+                if hasattr(listener, "on_post_text_command"):
+                    listener.on_post_text_command(self, name, args)
+
+
+# -- Built-in commands ----------------------------------------------------
+# Every cursor is handled from the bottom up, so that the points above are
+# still good.
+
+def _insert(view, characters):
+    for region in reversed(list(view._sel)):
+        view._modify(region.begin(), region.end(), characters)
+
+
+def _left_delete(view):
+    for region in reversed(list(view._sel)):
+        if region.empty():
+            region = Region(max(region.a - 1, 0), region.a)
+        view._modify(region.begin(), region.end(), "")
+
+
+def _right_delete(view):
+    for region in reversed(list(view._sel)):
+        if region.empty():
+            region = Region(region.a, min(region.a + 1, len(view._text)))
+        view._modify(region.begin(), region.end(), "")
+
+
+_BUILTIN_COMMANDS = {
+    "insert": _insert,
+    "left_delete": _left_delete,
+    "right_delete": _right_delete,
+}
+
+
+# Event listeners notified by View modifications.
+LISTENERS = []
+
+_settings = {}
+_timeouts = []
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def save_settings(name):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    _timeouts.append(callback)
+
+
+def set_timeout_async(callback, delay=0):
+    _timeouts.append(callback)
+
+
+def run_timeouts():
+    """Run the callbacks scheduled by set_timeout, ignoring the delays."""
+    while _timeouts:
+        _timeouts.pop(0)()
+
+
+def error_message(message):
+    raise RuntimeError(message)
+
+
+def message_dialog(message):
+    pass
+
+
+def status_message(message):
+    pass
+
+
+def active_window():
+    return None
+
+
+def platform():
+    return "linux"
+
+
+def cache_path():
+    import tempfile
+    return tempfile.gettempdir()
@@ -0,0 +1,40 @@
+"""A stand-in for the sublime_plugin module, see sublime.py."""
+# LICENSE: MIT
+
+import re
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class EventListener(object):
+    pass
+
+
+def _command_name(cls):
+    name = cls.__name__
+    if name.endswith("Command"):
+        name = name[:-len("Command")]
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', name).lower()
+
+
+def find_command(name):
+    """Return the command class named name, as in view.run_command."""
+    pending = [TextCommand, WindowCommand, ApplicationCommand]
+    while pending:
+        cls = pending.pop()
+        if _command_name(cls) == name and cls.__module__ != __name__:
+            return cls
+        pending.extend(cls.__subclasses__())
+    raise KeyError(name)
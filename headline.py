@@ -4,16 +4,23 @@ Terminologies
 - Headline :: The headline entity OR the text of the headline
 - Content :: The content under the current headline. It stops after
   encountering a headline with the same or higher level OR EOF.
+- Outline :: The sorted index of every headline in a view. It's built once
+  and patched after local edits (see OutlineListener), and used to answer
+  all the headline queries below.
 """
 # Author: Muchenxuan Tong <demon386@gmail.com>
 
 import re
+import bisect
+from array import array
+
 import sublime
+import sublime_plugin
 
 try:
-    from .utilities import is_region_void
+    from .utilities import FENCE_PATTERN, FoldedRegions, next_fence
 except ValueError:
-    from utilities import is_region_void
+    from utilities import FENCE_PATTERN, FoldedRegions, next_fence
 
 MATCH_PARENT = 1   # Match headlines at the same or higher level
 MATCH_CHILD = 2    # Match headlines at the same or lower level
@@ -21,77 +28,411 @@ MATCH_SILBING = 3  # Only Match headlines at the same level.
 MATCH_ANY = 4      # Any headlines would be matched.
 ANY_LEVEL = -1     # level used when MATCH_ANY is used as match type
 
+# Either a line opening or closing a fenced code block (the fence and what
+# follows it), or a headline (its #s).
+FENCE_OR_HEADLINE_PATTERN = re.compile(r'^(?:%s|(#+)[^\S\n].*)'
+                                       % FENCE_PATTERN.pattern, re.M)
+
+# Outline of every view seen so far, keyed by view id.
+_outlines = {}
+
+# Commands which only modify the lines around the cursors, so that the
+# outline can be patched rather than rebuilt after them.
+_LOCAL_EDIT_COMMANDS = ('insert', 'left_delete', 'right_delete',
+                        'delete_word', 'smart_list', 'change_heading_level')
+
+# Text command running in every view, keyed by view id, as (name, args).
+_running_commands = {}
+
+# Above this size (in characters), a dirty span is rescanned as a whole.
+_MAX_DIRTY_SPAN = 1 << 16
+
+
+class _Outline(object):
+    """Sorted index of the headlines of a buffer.
+
+    The headlines are kept as three parallel arrays, sorted by offset:
+    the start and end of every headline region and its level. The fenced
+    code blocks, in which no line is a headline, are kept as two more arrays.
+    The index is only valid for the change count it was built with.
+
+    """
+    def __init__(self, change_count, size):
+        self.change_count = change_count
+        self.size = size
+        self.starts = array('l')
+        self.ends = array('l')
+        self.levels = array('l')
+        self.code_starts = array('l')
+        self.code_ends = array('l')
+        # Pending modification as [lo, hi, delta]: everything outside of
+        # [lo, hi] (in current coordinates) is unchanged, shifted by delta
+        # after hi.
+        self.dirty = None
+        self.dirty_change_count = None
+
+    def append(self, start, end, level):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.levels.append(level)
+
+    def region(self, index):
+        return sublime.Region(self.starts[index], self.ends[index])
+
+    def headline_at(self, point):
+        """Return the index of the headline containing point, or None."""
+        index = bisect.bisect_right(self.starts, point) - 1
+        if index >= 0 and point <= self.ends[index]:
+            return index
+        return None
+
+    def find_forward(self, index, level, match_type=MATCH_ANY):
+        """Return the first index from index on matching the level."""
+        levels = self.levels
+        for i in range(max(index, 0), len(levels)):
+            if _is_level_matched(levels[i], level, match_type):
+                return i
+        return None
+
+    def find_backward(self, index, level, match_type=MATCH_ANY):
+        """Return the last index up to index matching the level."""
+        levels = self.levels
+        for i in range(min(index, len(levels) - 1), -1, -1):
+            if _is_level_matched(levels[i], level, match_type):
+                return i
+        return None
+
+    def add_dirty(self, lo, hi, delta, change_count):
+        """Record a modification of [lo, hi], which changed size by delta."""
+        if self.dirty is not None:
+            dirty_lo, dirty_hi, dirty_delta = self.dirty
+            old_hi = hi - delta
+
+            def move(point):
+                if point <= lo:
+                    return point
+                elif point >= old_hi:
+                    return point + delta
+                return hi
+
+            lo = min(lo, move(dirty_lo))
+            hi = max(hi, move(dirty_hi))
+            delta += dirty_delta
+        self.dirty = [lo, hi, delta]
+        self.dirty_change_count = change_count
+
+    def patch(self, view, change_count):
+        """Rescan the dirty lines only. Return False if a rebuild is needed.
+        """
+        if self.dirty is None or self.dirty_change_count != change_count:
+            return False
+        lo, hi, delta = self.dirty
+        if hi - lo > _MAX_DIRTY_SPAN or self.size + delta != view.size():
+            return False
+
+        old_hi = hi - delta
+        # A fence added or removed changes the code blocks down to EOF.
+        code_first = bisect.bisect_left(self.code_starts, lo)
+        code_last = bisect.bisect_right(self.code_starts, old_hi)
+        if code_first != code_last:
+            return False
+        if code_first > 0 and lo <= self.code_ends[code_first - 1] <= old_hi:
+            return False
+        dirty = _Outline(change_count, hi - lo)
+        if _scan_text(dirty, view.substr(sublime.Region(lo, hi)), lo):
+            return False
+        in_code_block = code_first > 0 and self.code_ends[code_first - 1] > old_hi
+
+        first = bisect.bisect_left(self.starts, lo)
+        last = bisect.bisect_right(self.starts, old_hi)
+
+        if in_code_block:
+            starts, ends, levels = array('l'), array('l'), array('l')
+            self.code_ends[code_first - 1] += delta
+        else:
+            starts, ends, levels = dirty.starts, dirty.ends, dirty.levels
+        if delta:
+            for i in range(code_last, len(self.code_starts)):
+                self.code_starts[i] += delta
+                self.code_ends[i] += delta
+
+        if delta:
+            starts.extend(s + delta for s in self.starts[last:])
+            ends.extend(e + delta for e in self.ends[last:])
+        else:
+            starts.extend(self.starts[last:])
+            ends.extend(self.ends[last:])
+        levels.extend(self.levels[last:])
+        self.starts[first:] = starts
+        self.ends[first:] = ends
+        self.levels[first:] = levels
+
+        self.size += delta
+        self.change_count = change_count
+        self.dirty = None
+        return True
+
+
+def _get_outline(view):
+    """Return the outline of the view, bringing it up to date if needed.
+    """
+    outline = _outlines.get(view.id())
+    change_count = view.change_count()
+    if outline is None or (outline.change_count != change_count and
+                           not outline.patch(view, change_count)):
+        outline = _build_outline(view)
+        _outlines[view.id()] = outline
+    return outline
+
+
+def _build_outline(view):
+    change_count = view.change_count()
+    text = view.substr(sublime.Region(0, view.size()))
+    outline = _Outline(change_count, len(text))
+    _scan_text(outline, text)
+    return outline
+
+
+def _scan_text(outline, text, offset=0):
+    """Add the headlines and fenced code blocks in text to the outline.
+
+    Lines inside fenced code blocks are skipped, whatever they start with,
+    in a single pass and without querying the scope of every candidate.
+    Indented code blocks needn't be tracked, since a headline has to start
+    at the beginning of its line.
+
+    Return the number of fence lines in text.
+
+    """
+    fence = None
+    fence_start = None
+    fence_count = 0
+    for match in FENCE_OR_HEADLINE_PATTERN.finditer(text):
+        marker = match.group(1)
+        if marker is None:
+            if fence is None:
+                outline.append(offset + match.start(), offset + match.end(),
+                               len(match.group(3)))
+            continue
+        new_fence = next_fence(fence, marker, match.group(2))
+        if fence is None and new_fence is not None:
+            fence_start = offset + match.start()
+            fence_count += 1
+        elif fence is not None and new_fence is None:
+            outline.code_starts.append(fence_start)
+            outline.code_ends.append(offset + match.end())
+            fence_count += 1
+        fence = new_fence
+    # An unclosed code block runs to EOF.
+    if fence is not None:
+        outline.code_starts.append(fence_start)
+        outline.code_ends.append(offset + len(text))
+    return fence_count
+
+
+def _mark_outline_dirty(view):
+    """Record the lines touched by the last modification of the view.
+
+    The modified span is guessed from the cursors, so it's only trusted while
+    a command which edits around them is running. Otherwise (undo, redo,
+    revert, a reload or any other command) the outline is dropped.
+
+    """
+    outline = _outlines.get(view.id())
+    if outline is None:
+        return
+
+    command, args = _running_commands.get(view.id(), (None, None))
+    selections = view.sel()
+    if command not in _LOCAL_EDIT_COMMANDS or len(selections) == 0:
+        del _outlines[view.id()]
+        return
+
+    pending_size = outline.size
+    if outline.dirty is not None:
+        pending_size += outline.dirty[2]
+    delta = view.size() - pending_size
+    characters = (args or {}).get('characters', '')
+    lo = selections[0].begin() - max(delta, len(characters), 0)
+    lo = view.line(max(lo, 0)).a
+    # One more line above, for the line joined or split at the cursor.
+    if lo > 0:
+        lo = view.line(lo - 1).a
+    hi = view.line(selections[len(selections) - 1].end()).b
+    outline.add_dirty(lo, hi, delta, view.change_count())
+
+
+class OutlineListener(sublime_plugin.EventListener):
+    """Keep the outline of the views in sync with their modifications."""
+    def on_text_command(self, view, command_name, args):
+        _running_commands[view.id()] = (command_name, args)
+
+    def on_post_text_command(self, view, command_name, args):
+        _running_commands.pop(view.id(), None)
+
+    def on_modified(self, view):
+        _mark_outline_dirty(view)
+
+    def on_close(self, view):
+        _outlines.pop(view.id(), None)
+        _running_commands.pop(view.id(), None)
+
+
+def _is_level_matched(headline_level, level, match_type):
+    if match_type == MATCH_ANY:
+        return True
+    elif match_type == MATCH_PARENT:
+        return headline_level <= level
+    elif match_type == MATCH_CHILD:
+        return headline_level >= level
+    elif match_type == MATCH_SILBING:
+        return headline_level == level
+    return False
+
 
 def region_of_content_of_headline_at_point(view, from_point):
     """Extract the region of the content of under current headline."""
-    _, level = headline_and_level_at_point(view, from_point)
-    if level == None:
+    outline = _get_outline(view)
+    index = outline.headline_at(from_point)
+    if index is None:
         return None
 
-    if is_content_empty_at_point(view, from_point):
+    if _is_content_empty(outline, index):
         return None
 
-    line_num, _ = view.rowcol(from_point)
-    content_line_start_point = view.text_point(line_num + 1, 0)
-
-    next_headline, _ = find_headline(view, \
-                                     content_line_start_point, \
-                                     level, \
-                                     True, \
-                                     MATCH_PARENT)
-    if not is_region_void(next_headline):
-        end_pos = next_headline.a - 1
+    content_line_start_point = outline.ends[index] + 1
+    next_index = outline.find_forward(index + 1, outline.levels[index],
+                                      MATCH_PARENT)
+    if next_index is not None:
+        end_pos = outline.starts[next_index] - 1
     else:
-        end_pos = view.size()
+        end_pos = outline.size
     return sublime.Region(content_line_start_point, end_pos)
 
 
-def headline_and_level_at_point(view, from_point, search_above_and_down=False):
-    """Return the current headline and level.
+def region_of_section_at_point(view, from_point):
+    """Return the region of the section from_point is in.
+
+    The section is the headline at or above from_point together with its
+    content, so it includes the sub-headlines. Before the first headline,
+    it's the text up to the first headline.
 
-    If from_point is inside a headline, then return the headline and level.
-    Otherwise depends on the argument it might search above and down.
     """
-    line_region = view.line(from_point)
-    line_content = view.substr(line_region)
-    # Update the level in case it's headline.ANY_LEVEL
-    level = _extract_level_from_headline(line_content)
+    _, level = headline_and_level_at_point(view, from_point)
+    if level is not None:
+        headline_region = view.line(from_point)
+    else:
+        headline_region, level = find_headline(view, from_point, ANY_LEVEL,
+                                               forward=False)
+    if level is None:
+        first_region, _ = find_headline(view, 0, ANY_LEVEL)
+        if first_region.a < 0:
+            return sublime.Region(0, view.size())
+        return sublime.Region(0, first_region.a)
 
-    # Search above and down
-    if level is None and search_above_and_down:
-        # Search above
-        headline_region, _ = find_headline(view,\
-                                           from_point,\
-                                           ANY_LEVEL,
-                                           False,
-                                           skip_folded=True)
-        if not is_region_void(headline_region):
-            line_content, level = headline_and_level_at_point(view,\
-                                                              headline_region.a)
-        # Search down
-        if level is None:
-            headline_region, _ = find_headline(view,\
-                                               from_point,\
-                                               ANY_LEVEL,
-                                               True,
-                                               skip_folded=True)
-            if not is_region_void(headline_region):
-                line_content, level = headline_and_level_at_point(view, headline_region.a)
+    content_region = region_of_content_of_headline_at_point(view,
+                                                            headline_region.a)
+    if content_region is None:
+        return headline_region
+    return sublime.Region(headline_region.a, content_region.b)
 
-    return line_content, level
 
+def regions_of_top_sections(view):
+    """Split the buffer at the headlines of the top level.
 
-def _extract_level_from_headline(headline):
-    """Extract the level of headline, None if not found.
+    The top level is the highest level of the buffer's headlines, so a
+    document whose headlines all start at ## is split at them. The text
+    before the first of them is a section too.
+
+    Returns
+    -------
+    regions: list
+        The regions of the sections, covering the whole buffer.
 
     """
-    re_string = _get_re_string(ANY_LEVEL, MATCH_ANY)
-    match = re.match(re_string, headline)
+    outline = _get_outline(view)
+    if len(outline.levels) == 0:
+        return [sublime.Region(0, outline.size)]
+    top_level = min(outline.levels)
+    bounds = [0]
+    for (start, level) in zip(outline.starts, outline.levels):
+        if level == top_level and start > 0:
+            bounds.append(start)
+    bounds.append(outline.size)
+    return [sublime.Region(bounds[i], bounds[i + 1])
+            for i in range(len(bounds) - 1)]
+
+
+def regions_of_content_of_headlines(view, region=None):
+    """Generate the regions of the content of the top headlines in region.
+
+    A top headline is the first one in region, or the one following the
+    content of the previous top headline. The headlines with empty content
+    are skipped. All the regions are computed in one sweep of the outline.
+
+    Parameters
+    ----------
+    view: sublime.view
 
-    if match:
-        return len(match.group(1))
+    region: sublime.Region
+        The region in which to find the top headlines. The whole buffer
+        if None.
+
+    """
+    outline = _get_outline(view)
+    starts, ends, levels = outline.starts, outline.ends, outline.levels
+    count = len(starts)
+    if region is None:
+        index, stop = 0, outline.size
     else:
-        return None
+        index = bisect.bisect_left(starts, region.begin())
+        stop = region.end()
+
+    while index < count and ends[index] <= stop:
+        next_index = index + 1
+        while next_index < count and levels[next_index] > levels[index]:
+            next_index += 1
+        if not _is_content_empty(outline, index):
+            if next_index < count:
+                end_pos = starts[next_index] - 1
+            else:
+                end_pos = outline.size
+            yield sublime.Region(ends[index] + 1, end_pos)
+        index = next_index
+
+
+def headline_and_level_at_point(view, from_point, search_above_and_down=False,
+                                folds=None):
+    """Return the current headline and level.
+
+    If from_point is inside a headline, then return the headline and level.
+    Otherwise depends on the argument it might search above and down,
+    skipping the folded headlines (folds is the FoldedRegions snapshot to
+    use, if any).
+    """
+    outline = _get_outline(view)
+    index = outline.headline_at(from_point)
+    if index is not None:
+        return view.substr(outline.region(index)), outline.levels[index]
+    line_content = view.substr(view.line(from_point))
+    level = None
+
+    # Search above and down
+    if level is None and search_above_and_down:
+        if folds is None:
+            folds = FoldedRegions.of_view(view)
+        for forward in (False, True):
+            headline_region, level = find_headline(view,
+                                                   from_point,
+                                                   ANY_LEVEL,
+                                                   forward,
+                                                   skip_folded=True,
+                                                   folds=folds)
+            if level is not None:
+                line_content = view.substr(headline_region)
+                break
+
+    return line_content, level
 
 
 def is_content_empty_at_point(view, from_point):
@@ -101,25 +442,27 @@ def is_content_empty_at_point(view, from_point):
     or higher level.
 
     """
-    _, level = headline_and_level_at_point(view, from_point)
-    if level is None:
+    outline = _get_outline(view)
+    index = outline.headline_at(from_point)
+    if index is None:
         raise ValueError("from_point must be inside a valid headline.")
+    return _is_content_empty(outline, index)
 
-    line_num, _ = view.rowcol(from_point)
-    next_line_region = view.line(view.text_point(line_num + 1, 0))
-    next_line_content = view.substr(next_line_region)
-    next_line_level = _extract_level_from_headline(next_line_content)
 
+def _is_content_empty(outline, index):
+    content_line_start_point = outline.ends[index] + 1
     # Note that EOF works too in this case.
-    if next_line_level and next_line_level <= level:
+    if content_line_start_point > outline.size:
         return True
-    else:
-        return False
+    next_index = index + 1
+    return next_index < len(outline.starts) and \
+        outline.starts[next_index] == content_line_start_point and \
+        outline.levels[next_index] <= outline.levels[index]
 
 
 def find_headline(view, from_point, level, forward=True, \
                   match_type=MATCH_ANY, skip_headline_at_point=False, \
-                  skip_folded=False):
+                  skip_folded=False, folds=None):
     """Return the region of the next headline or EOF.
 
     Parameters
@@ -144,120 +487,53 @@ def find_headline(view, from_point, level, forward=True, \
     skip_folded: boolean
         Whether to skip the folded region
 
+    folds: utilities.FoldedRegions
+        Snapshot of the folded regions used by skip_folded. Taken from the
+        view if not given.
+
     Returns
     -------
     match_region: int
-        Matched region, or None if not found.
+        Matched region, or Region(-1, -1) if not found.
 
     match_level: int
         The level of matched headline, or None if not found.
 
     """
+    if not skip_folded:
+        folds = None
+    elif folds is None:
+        folds = FoldedRegions.of_view(view)
+
+    outline = _get_outline(view)
     if skip_headline_at_point:
         # Move the point to the next line if we are
         # current in a headline already.
-        from_point = _get_new_point_if_already_in_headline(view, from_point,
-                                                           forward)
+        index = outline.headline_at(from_point)
+        if index is not None:
+            if forward:
+                from_point = outline.ends[index] + 1
+            else:
+                from_point = outline.starts[index] - 1
 
-    re_string = _get_re_string(level, match_type)
     if forward:
-        match_region = view.find(re_string, from_point)
+        index = bisect.bisect_left(outline.starts, from_point)
     else:
-        all_match_regions = view.find_all(re_string)
-        match_region = _nearest_region_among_matches_from_point(view, \
-                                                                all_match_regions, \
-                                                                from_point, \
-                                                                False, \
-                                                                skip_folded)
-
-    if skip_folded:
-        while (_is_region_folded(match_region, view)):
-            from_point = match_region.b
-            match_region = view.find(re_string, from_point)
-
-    if not is_region_void(match_region):
-        if not is_scope_headline(view, match_region.a):
-            return find_headline(view, match_region.a, level, forward, \
-                                 match_type, True, skip_folded)
-        else:
-            ## Extract the level of matched headlines according to the region
-            headline = view.substr(match_region)
-            match_level = _extract_level_from_headline(headline)
-    else:
-        match_level = None
-    return (match_region, match_level)
-
-def _get_re_string(level, match_type=MATCH_ANY):
-    """Get regular expression string according to match type.
-
-    Return regular expression string, rather than compiled string. Since
-    sublime's view.find function needs string.
-
-    Parameters
-    ----------
-    match_type: int
-        MATCH_SILBING, MATCH_PARENT, MATCH_CHILD or ANY_LEVEL.
+        index = bisect.bisect_right(outline.ends, from_point) - 1
 
-    """
-    if match_type == MATCH_ANY:
-        re_string = r'^(#+)\s.*'
-    else:
-        try:
-            if match_type == MATCH_PARENT:
-                re_string = r'^(#{1,%d})\s.*' % level
-            elif match_type == MATCH_CHILD:
-                re_string = r'^(#{%d,})\s.*' % level
-            elif match_type == MATCH_SILBING:
-                re_string = r'^(#{%d,%d})\s.*' % (level, level)
-        except ValueError:
-            print("match_type has to be specified if level isn't ANY_LEVE")
-    return re_string
-
-
-def _get_new_point_if_already_in_headline(view, from_point, forward=True):
-    line_content = view.substr(view.line(from_point))
-    if _extract_level_from_headline(line_content):
-        line_num, _ = view.rowcol(from_point)
+    while True:
         if forward:
-            return view.text_point(line_num + 1, 0)
+            index = outline.find_forward(index, level, match_type)
         else:
-            return view.text_point(line_num, 0) - 1
-    else:
-        return from_point
+            index = outline.find_backward(index, level, match_type)
+        if index is None:
+            return (sublime.Region(-1, -1), None)
+        match_region = outline.region(index)
+        if folds is None or not folds.contains(match_region):
+            return (match_region, outline.levels[index])
+        index += 1 if forward else -1
 
 
 def is_scope_headline(view, from_point):
     return view.score_selector(from_point, "markup.heading") > 0 or \
         view.score_selector(from_point, "meta.block-level.markdown") > 0
-
-
-def _nearest_region_among_matches_from_point(view, all_match_regions, \
-                                             from_point, forward=False,
-                                             skip_folded=True):
-    """Find the nearest matched region among all matched regions.
-
-    None if not found.
-
-    """
-    nearest_region = None
-
-    for r in all_match_regions:
-        if not forward and r.b <= from_point and \
-            (not nearest_region or r.a > nearest_region.a):
-            candidate = r
-        elif forward and r.a >= from_point and \
-            (not nearest_region or r.b < nearest_region.b):
-            candidate = r
-        else:
-            continue
-        if skip_folded and not _is_region_folded(candidate, view):
-            nearest_region = candidate
-
-    return nearest_region
-
-
-def _is_region_folded(region, view):
-    for i in view.folded_regions():
-        if i.contains(region):
-            return True
-    return False
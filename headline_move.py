@@ -10,10 +10,10 @@ import sublime_plugin
 
 try:
     from . import headline
-    from .utilities import is_region_void
+    from .utilities import is_region_void, FoldedRegions
 except ValueError:
     import headline
-    from utilities import is_region_void
+    from utilities import is_region_void, FoldedRegions
 
 
 class HeadlineMoveCommand(sublime_plugin.TextCommand):
@@ -30,11 +30,13 @@ class HeadlineMoveCommand(sublime_plugin.TextCommand):
         else:
             level_type = headline.MATCH_ANY
 
+        folds = FoldedRegions.of_view(self.view)
         for region in self.view.sel():
             if same_level:
                 _, level = headline.headline_and_level_at_point(self.view,\
                                                                 region.a,
-                                                                search_above_and_down=True)
+                                                                search_above_and_down=True,
+                                                                folds=folds)
                 if level is None:
                     return
             else:
@@ -46,7 +48,8 @@ class HeadlineMoveCommand(sublime_plugin.TextCommand):
                                                      forward, \
                                                      level_type, \
                                                      skip_headline_at_point=True,\
-                                                     skip_folded=True)
+                                                     skip_folded=True,\
+                                                     folds=folds)
 
             if is_region_void(match_region):
                 return
@@ -0,0 +1,230 @@
+"""Live HTML preview of a view, rendered by pandoc while it's edited.
+
+Terminologies
+
+- Section :: The text from a headline of the top level to the next one, see
+headline.regions_of_top_sections. Every section is rendered on its own, and
+its HTML is kept by its key (see render_cache), so that only the sections
+which changed are rendered again.
+
+The preview is rendered once the typing stops for "live_preview_delay"
+milliseconds. The page polls a tiny script written next to it, which tells
+the page to reload when the preview has been rendered again.
+
+As the sections are rendered separately, what spans them (reference links,
+footnotes...) may not be rendered as in the whole document.
+"""
+# LICENSE: MIT
+
+import os
+import os.path
+import webbrowser
+
+import sublime
+import sublime_plugin
+
+try:
+    from . import headline
+    from . import pandoc_render
+    from . import render_cache
+except ValueError:
+    import headline
+    import pandoc_render
+    import render_cache
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<script>
+(function () {
+    var version = %(version)d;
+    window.smartMarkdownPreview = function (newVersion) {
+        if (newVersion !== version) {
+            location.reload();
+        }
+    };
+    function poll() {
+        var script = document.createElement("script");
+        script.src = "%(version_file)s?" + new Date().getTime();
+        script.onload = script.onerror = function () {
+            script.parentNode.removeChild(script);
+            setTimeout(poll, 500);
+        };
+        document.head.appendChild(script);
+    }
+    setTimeout(poll, 500);
+})();
+</script>
+</head>
+<body>
+%(body)s
+</body>
+</html>
+"""
+
+# The arguments of pandoc making a whole HTML document rather than a
+# fragment, which are left out when rendering the sections.
+STANDALONE_ARGS = ("-s", "--standalone", "--self-contained",
+                   "--embed-resources")
+
+# The live preview of every view, keyed by view id.
+_previews = {}
+
+
+class PandocLivePreviewCommand(sublime_plugin.TextCommand):
+    """Start (and open) the live preview of the view, or stop it."""
+    def is_enabled(self):
+        return self.view.score_selector(0, "text.html.markdown") > 0
+
+    def run(self, edit):
+        preview = _previews.pop(self.view.id(), None)
+        if preview is not None:
+            preview.cancel()
+            sublime.status_message("Pandoc: live preview stopped")
+            return
+        preview = LivePreview(self.view)
+        _previews[self.view.id()] = preview
+        preview.render(open_after=True)
+
+
+class LivePreviewListener(sublime_plugin.EventListener):
+    """Render the live previews again once the typing stops."""
+    def on_modified(self, view):
+        preview = _previews.get(view.id())
+        if preview is not None:
+            preview.schedule(pandoc_render.get_settings().live_preview_delay)
+
+    def on_close(self, view):
+        preview = _previews.pop(view.id(), None)
+        if preview is not None:
+            preview.cancel()
+            preview.remove_files()
+
+
+class LivePreview(object):
+    """The live preview of a view.
+
+    Attributes
+    ----------
+    sections: dict
+        The HTML of the sections of the last render, keyed by their key.
+    batch: pandoc_render.PandocBatch
+        The sections being rendered, or None.
+    version: int
+        The number of times the page has been written.
+
+    """
+    def __init__(self, view):
+        self.view = view
+        self.sections = {}
+        self.batch = None
+        self.version = 0
+        self.generation = 0
+        self.file_name = pandoc_render.get_temp_output_name(view,
+                                                            "-preview.html")
+        self.version_file_name = pandoc_render.get_temp_output_name(
+            view, "-preview.js")
+
+    def schedule(self, delay):
+        """Render after delay, unless it's scheduled again in the meantime.
+        """
+        self.generation += 1
+        generation = self.generation
+
+        def render():
+            if self.generation == generation and \
+                    _previews.get(self.view.id()) is self:
+                self.render()
+        sublime.set_timeout(render, delay)
+
+    def render(self, open_after=False):
+        """Render the sections which changed, and write the page.
+
+        The render in progress, if any, is superseded.
+        """
+        settings = pandoc_render.get_settings()
+        # The sections are put together in one page.
+        args = [arg for arg in settings.args["html"]
+                if arg.split("=", 1)[0] not in STANDALONE_ARGS]
+        version = pandoc_render.get_pandoc_version(settings.env) or ""
+        file_name = self.view.file_name()
+        working_dir = os.path.dirname(file_name) if file_name else None
+
+        keys = []
+        renders = []
+        for region in headline.regions_of_top_sections(self.view):
+            contents = self.view.substr(region).encode("utf-8")
+            key = render_cache.make_key(contents, args, version,
+                                        working_dir or "")
+            if key not in self.sections and key not in keys:
+                job = pandoc_render.PandocJob(["pandoc"] + args, working_dir,
+                                              contents, settings.env)
+                renders.append((key, job))
+            keys.append(key)
+
+        self.cancel()
+        if not renders:
+            self.write(keys, {}, open_after)
+            return
+
+        def on_done(batch):
+            if self.batch is not batch:
+                return
+            self.batch = None
+            errors = {}
+            for (key, job) in renders:
+                if job.returncode == 0:
+                    self.sections[key] = job.out.decode("utf-8", "replace")
+                else:
+                    # Not kept, so that it's rendered again next time.
+                    errors[key] = '<pre class="pandoc-error">%s</pre>' % \
+                        _escape(job.error_text())
+            self.write(keys, errors, open_after)
+
+        self.batch = pandoc_render.PandocBatch(
+            [job for (_, job) in renders], settings.max_workers)
+        self.batch.start(on_done)
+
+    def write(self, keys, errors, open_after=False):
+        """Write the page of the sections of keys, and tell it to reload.
+        """
+        # The sections which are gone are forgotten.
+        self.sections = dict([(key, self.sections[key]) for key in keys
+                              if key in self.sections])
+        body = "\n".join([self.sections.get(key) or errors.get(key, "")
+                          for key in keys])
+        file_name = self.view.file_name()
+        self.version += 1
+        page = PAGE_TEMPLATE % {
+            "title": _escape(os.path.basename(file_name) if file_name
+                             else "Preview"),
+            "version": self.version,
+            "version_file": os.path.basename(self.version_file_name),
+            "body": body}
+        # Written aside first, so that the browser never reads half a file.
+        render_cache.write_file(self.file_name, page.encode("utf-8"))
+        render_cache.write_file(
+            self.version_file_name,
+            ("smartMarkdownPreview(%d);\n" % self.version).encode("utf-8"))
+        if open_after:
+            webbrowser.open_new_tab(self.file_name)
+
+    def cancel(self):
+        """Cancel the render in progress, if any."""
+        if self.batch is not None:
+            self.batch.cancel()
+            self.batch = None
+
+    def remove_files(self):
+        for file_name in (self.file_name, self.version_file_name):
+            if os.path.exists(file_name):
+                try:
+                    os.remove(file_name)
+                except OSError:
+                    pass
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -0,0 +1,219 @@
+"""Build the Markdown files of the project folders with pandoc.
+
+Terminologies
+
+- Manifest :: The render key (see render_cache) of every output of a folder,
+as of its last build. A file is only rendered again when its key changed,
+i.e. when its source, the pandoc arguments or the pandoc version changed, or
+when its output is gone.
+
+The manifests are kept in the cache directory of the package, so that the
+folders aren't cluttered. The files are read and hashed in a background
+thread, and rendered by a PandocBatch.
+"""
+# LICENSE: MIT
+
+import json
+import os
+import os.path
+import threading
+import time
+
+import sublime
+import sublime_plugin
+
+try:
+    from . import pandoc_render
+    from . import render_cache
+except ValueError:
+    import pandoc_render
+    import render_cache
+
+MARKDOWN_EXTENSIONS = (".md", ".markdown", ".mdown", ".mkd")
+
+# The build in progress of every window, keyed by window id.
+_builds = {}
+# Bumped by every build of a window, so that a scan outdated by a newer
+# build is dropped.
+_build_generations = {}
+
+
+class PandocBuildCommand(sublime_plugin.WindowCommand):
+    """Render the Markdown files of the folders of the window which changed
+    since the last build, next to them.
+    """
+    def is_enabled(self):
+        return len(self.window.folders()) > 0
+
+    def run(self, target="html", dirs=None, force=False):
+        if target not in ["html", "docx", "pdf"]:
+            raise Exception("Format %s currently unsopported" % target)
+
+        settings = pandoc_render.get_settings()
+        folders = dirs or self.window.folders()
+
+        window = self.window
+        window_id = window.id()
+        generation = _build_generations.get(window_id, 0) + 1
+        _build_generations[window_id] = generation
+        cancel_build(window)
+        sublime.status_message("Pandoc build: looking for Markdown files...")
+
+        def scan():
+            start = time.time()
+            version = pandoc_render.get_pandoc_version(settings.env)
+            plan = plan_build(folders, target, settings, version, force)
+            sublime.set_timeout(lambda: start_build(plan, start), 0)
+
+        def start_build(plan, start):
+            if _build_generations.get(window_id) != generation:
+                return
+            (manifests, renders, up_to_date) = plan
+            if not renders:
+                sublime.status_message("Pandoc build: %d files up to date"
+                                       % up_to_date)
+                return
+            jobs = [job for (job, _, _, _) in renders]
+
+            def on_done(batch):
+                if _builds.get(window_id) is not batch:
+                    return
+                del _builds[window_id]
+                errors = []
+                for (job, folder, output_name, key) in renders:
+                    rel_name = os.path.relpath(output_name, folder)
+                    error = pandoc_render.finish_job(job, target, output_name)
+                    if error:
+                        manifests[folder].pop(rel_name, None)
+                        errors.append("%s\n%s" % (output_name, error))
+                    else:
+                        manifests[folder][rel_name] = key
+                for folder in manifests:
+                    save_manifest(folder, manifests[folder])
+                sublime.status_message(
+                    "Pandoc build: %d rendered, %d up to date, %d failed "
+                    "(%.1fs)" % (len(renders) - len(errors), up_to_date,
+                                 len(errors), time.time() - start))
+                if errors:
+                    sublime.error_message(
+                        "Pandoc build: fail to generate %d of %d outputs.\n\n"
+                        % (len(errors), len(renders))
+                        + "\n\n".join(errors))
+
+            batch = pandoc_render.PandocBatch(jobs, settings.max_workers)
+            _builds[window_id] = batch
+            batch.start(on_done)
+            _show_progress(window_id, batch)
+
+        threading.Thread(target=scan).start()
+
+
+class PandocCancelBuildCommand(sublime_plugin.WindowCommand):
+    """Cancel the build in progress of the window."""
+    def is_enabled(self):
+        return self.window.id() in _builds
+
+    def run(self):
+        if cancel_build(self.window):
+            sublime.status_message("Pandoc build: cancelled")
+
+
+def plan_build(folders, target, settings, version, force=False):
+    """Find the Markdown files of folders which need to be rendered.
+
+    settings is the pandoc_render.PandocSettings to render with.
+
+    Returns
+    -------
+    manifests: dict
+        The manifest of every folder.
+    renders: list
+        (job, folder, output_name, key) for every file to render, job being
+        a PandocJob.
+    up_to_date: int
+        The number of files which needn't be rendered.
+
+    """
+    args = settings.args[target]
+    manifests = {}
+    renders = []
+    up_to_date = 0
+    for folder in folders:
+        manifest = manifests[folder] = load_manifest(folder)
+        for (file_name, output_name) in find_markdown_files(folder, target):
+            try:
+                with open(file_name, "rb") as f:
+                    contents = f.read()
+            except (IOError, OSError):
+                continue
+            working_dir = os.path.dirname(file_name)
+            key = render_cache.make_key(contents, target, args,
+                                        version or "", working_dir)
+            if not force and version and \
+                    manifest.get(os.path.relpath(output_name, folder)) == key \
+                    and os.path.exists(output_name):
+                up_to_date += 1
+                continue
+            cmd = pandoc_render.pandoc_command(args, target, output_name)
+            job = pandoc_render.PandocJob(cmd, working_dir, contents,
+                                          settings.env)
+            renders.append((job, folder, output_name, key))
+    return (manifests, renders, up_to_date)
+
+
+def find_markdown_files(folder, target):
+    """Yield (file_name, output_name) for every Markdown file in folder.
+
+    The hidden directories (.git...) are skipped.
+    """
+    for (dir_path, dir_names, file_names) in os.walk(folder):
+        dir_names[:] = sorted([name for name in dir_names
+                               if not name.startswith(".")])
+        for name in sorted(file_names):
+            (root, ext) = os.path.splitext(name)
+            if ext.lower() in MARKDOWN_EXTENSIONS:
+                yield (os.path.join(dir_path, name),
+                       os.path.join(dir_path, root + "." + target))
+
+
+def get_manifest_name(folder):
+    """Return the path of the manifest of folder."""
+    return os.path.join(render_cache.get_cache_dir("build"),
+                        render_cache.make_key(os.path.abspath(folder)) +
+                        ".json")
+
+
+def load_manifest(folder):
+    """Return the manifest of folder, empty if there is none."""
+    try:
+        with open(get_manifest_name(folder)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(folder, manifest):
+    manifest_name = get_manifest_name(folder)
+    directory = os.path.dirname(manifest_name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    render_cache.write_file(manifest_name,
+                            json.dumps(manifest).encode("utf-8"))
+
+
+def cancel_build(window):
+    """Cancel the build in progress of window, return if there was one.
+    """
+    batch = _builds.pop(window.id(), None)
+    if batch is None:
+        return False
+    batch.cancel()
+    return True
+
+
+def _show_progress(window_id, batch):
+    if _builds.get(window_id) is not batch or not batch.is_alive():
+        return
+    sublime.status_message("Pandoc build: rendering %d/%d"
+                           % (batch.done_count, len(batch.jobs)))
+    sublime.set_timeout(lambda: _show_progress(window_id, batch), 100)
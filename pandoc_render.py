@@ -15,9 +15,31 @@ import tempfile
 import os
 import os.path
 import sys
+import shutil
 import subprocess
+import threading
+import time
 from subprocess import PIPE
 
+try:
+    from . import headline
+    from . import render_cache
+except ValueError:
+    import headline
+    import render_cache
+
+# The render in progress of every view, keyed by view id.
+_jobs = {}
+
+# The ids of the views which have temporary outputs.
+_temp_output_views = set()
+
+# The output of "pandoc --version", read once.
+_pandoc_version = None
+
+# The PandocSettings, resolved once per change of the settings.
+_settings = None
+
 
 class PandocRenderCommand(sublime_plugin.TextCommand):
     def is_enabled(self):
@@ -27,90 +49,110 @@ class PandocRenderCommand(sublime_plugin.TextCommand):
         return True
 
     def run(self, edit, target="pdf", open_after=True, save_result=False):
-        if target not in ["html", "docx", "pdf"]:
-            raise Exception("Format %s currently unsopported" % target)
+        self.render([target], open_after, save_result)
 
-        self.setting = sublime.load_settings("SmartMarkdown.sublime-settings")
+    def render(self, targets, open_after, save_result, region=None):
+        """Render the buffer (or its region) to every target, concurrently.
+
+        The buffer is read and encoded once, and the targets which can't be
+        reused from the cache are rendered by a pool of pandoc processes.
+
+        """
+        for target in targets:
+            if target not in ["html", "docx", "pdf"]:
+                raise Exception("Format %s currently unsopported" % target)
+
+        settings = get_settings()
 
         encoding = self.view.encoding()
         if encoding == 'Undefined':
             encoding = 'UTF-8'
         elif encoding == 'Western (Windows 1252)':
             encoding = 'windows-1252'
-        contents = self.view.substr(sublime.Region(0, self.view.size()))
+        if region is None:
+            region = sublime.Region(0, self.view.size())
+        contents = self.view.substr(region)
         contents = contents.encode(encoding)
 
         file_name = self.view.file_name()
-        if file_name:
-            os.chdir(os.path.dirname(file_name))
-
-        # write buffer to temporary file
-        # This is useful because it means we don't need to save the buffer
-        tmp_md = tempfile.NamedTemporaryFile(delete=False, suffix=".md")
-        tmp_md.write(contents)
-        tmp_md.close()
-
-        # output file...
-        suffix = "." + target
-        if save_result:
-            output_name = os.path.splitext(self.view.file_name())[0] + suffix
-            if not self.view.file_name():
-                raise Exception("Please safe the buffer before trying to export with pandoc.")
-        else:
-            output = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-            output.close()
-            output_name = output.name
-
-        args = self.pandoc_args(target)
-        self.run_pandoc(tmp_md.name, output_name, args)
-
-        if open_after:
-            self.open_result(output_name, target)
-        #os.unlink(tmp_md.name)
-
-    def run_pandoc(self, infile, outfile, args):
-        cmd = ['pandoc'] + args
-        cmd += [infile, "-o", outfile]
-
-        # Merge the path in settings
-        setting_path = self.setting.get("tex_path", [])
-        for p in setting_path:
-            if p not in os.environ["PATH"]:
-                os.environ["PATH"] += ":" + p
+        if save_result and not file_name:
+            raise Exception("Please safe the buffer before trying to export with pandoc.")
 
-        try:
-            # Use the current directory as working dir whenever possible
-            file_name = self.view.file_name()
-            if file_name:
-                working_dir = os.path.dirname(file_name)
-                p = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE,
-                                     cwd=working_dir)
+        # Use the current directory as working dir whenever possible
+        working_dir = os.path.dirname(file_name) if file_name else None
 
+        cache = render_cache.RenderCache(
+            render_cache.get_cache_dir("render"),
+            settings.cache_size)
+        version = get_pandoc_version(settings.env)
+
+        cached_targets = []
+        renders = []
+        jobs = []
+        for target in targets:
+            # output file...
+            suffix = "." + target
+            if save_result:
+                output_name = os.path.splitext(file_name)[0] + suffix
             else:
-                p = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
-            p.wait()
-            out, err = p.communicate()
-            if err:
-                raise Exception("Command: %s\n" % " ".join(cmd) + "\nErrors: " + err)
-        except Exception as e:
-            sublime.error_message("Fail to generate output.\n{0}".format(e))
-
-    def pandoc_args(self, target):
-        """
-        Create a list of arguments for the pandoc command
-        depending on the target.
-        TODO: Actually do something sensible here
-        """
-        # Merge the args in settings
-        args = self.setting.get("pandoc_args", [])
+                output_name = None
+            args = settings.args[target]
 
-        if target == "pdf":
-            args += self.setting.get("pandoc_args_pdf", [])
-        if target == "html":
-            args += self.setting.get("pandoc_args_html", []) + ['-t', 'html5']
-        if target == "docx":
-            args += self.setting.get("pandoc_args_docx", []) + ['-t', 'docx']
-        return args
+            # The same buffer rendered the same way is reused from the cache.
+            key = render_cache.make_key(contents, target, args, version or "",
+                                        working_dir or "")
+            cached = cache.get(key, suffix) if version else None
+            if cached is not None:
+                # Copied out, as the file in the cache may be evicted while
+                # it's open.
+                if output_name is None:
+                    output_name = get_temp_output_name(self.view, suffix)
+                shutil.copyfile(cached, output_name)
+                cached_targets.append(target)
+                if open_after:
+                    self.open_result(output_name, target)
+                continue
+
+            # The buffer is piped to pandoc, so that it needn't be saved.
+            # Every view has one temporary output per target, overwritten by
+            # each render.
+            if output_name is None:
+                output_name = get_temp_output_name(self.view, suffix)
+            renders.append((target, output_name, key))
+            jobs.append(PandocJob(pandoc_command(args, target, output_name),
+                                  working_dir, contents, settings.env))
+
+        if not jobs:
+            cancel_job(self.view)
+            sublime.status_message("Pandoc: %s reused from the cache"
+                                   % ", ".join(cached_targets))
+            return
+
+        def on_done(batch):
+            report = []
+            errors = []
+            for (job, (target, output_name, key)) in zip(batch.jobs, renders):
+                error = finish_job(job, target, output_name,
+                                   remove_on_error=not save_result)
+                if error:
+                    report.append("%s failed" % target)
+                    errors.append(error)
+                    continue
+                report.append("%s in %.1fs" % (target, job.elapsed))
+                if version:
+                    cache.put(key, "." + target, output_name)
+                if open_after:
+                    self.open_result(output_name, target)
+            report += ["%s cached" % target for target in cached_targets]
+            sublime.status_message("Pandoc: %s (%.1fs)"
+                                   % (", ".join(report), batch.elapsed))
+            if errors:
+                sublime.error_message("Fail to generate output.\n"
+                                      + "\n\n".join(errors))
+
+        batch = PandocBatch(jobs, settings.max_workers)
+        start_job(self.view, batch, "Pandoc: rendering %s"
+                  % ", ".join([target for (target, _, _) in renders]), on_done)
 
     def open_result(self, outfile, target):
         if target == "html":
@@ -122,3 +164,321 @@ class PandocRenderCommand(sublime_plugin.TextCommand):
             print(outfile)
         elif "posix" in sys.platform or "linux" in sys.platform:
             os.system("xdg-open %s" % outfile)
+
+
+class PandocCancelCommand(sublime_plugin.TextCommand):
+    """Cancel the render in progress of the view."""
+    def is_enabled(self):
+        return self.view.id() in _jobs
+
+    def run(self, edit):
+        if cancel_job(self.view):
+            sublime.status_message("Pandoc: rendering cancelled")
+
+
+class PandocRenderAllCommand(PandocRenderCommand):
+    """Render the buffer to several targets at once."""
+    def run(self, edit, targets=("html", "docx", "pdf"), open_after=False,
+            save_result=True):
+        self.render(list(targets), open_after, save_result)
+
+
+class PandocRenderSectionCommand(PandocRenderCommand):
+    """Render the section at point to a temporary HTML file and open it.
+
+    Only the section (see headline.region_of_section_at_point) is given to
+    pandoc, so that previewing an edit of a big document is fast.
+    """
+    def run(self, edit, open_after=True):
+        point = self.view.sel()[0].b
+        region = headline.region_of_section_at_point(self.view, point)
+        self.render(["html"], open_after, False, region)
+
+
+class PandocJob(object):
+    """A pandoc process, run by PandocBatch in a background thread.
+
+    input is written to the stdin of the process, and its output is read
+    with communicate(), so that it can't block on a full pipe.
+    """
+    def __init__(self, cmd, cwd, input=None, env=None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.input = input
+        self.env = env
+        self.process = None
+        self.cancelled = False
+        self.returncode = None
+        self.out = b""
+        self.err = b""
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Run the process and wait for it."""
+        start = time.time()
+        with self._lock:
+            if self.cancelled:
+                return
+            try:
+                self.process = subprocess.Popen(self.cmd, stdin=PIPE,
+                                                stdout=PIPE, stderr=PIPE,
+                                                cwd=self.cwd, env=self.env)
+            except OSError as e:
+                self.process = None
+                self.returncode = -1
+                self.err = str(e).encode("utf-8")
+        if self.process is not None:
+            self.out, self.err = self.process.communicate(self.input)
+            self.returncode = self.process.returncode
+        self.elapsed = time.time() - start
+
+    def cancel(self):
+        """Kill the process."""
+        with self._lock:
+            self.cancelled = True
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+
+    def error_text(self):
+        return self.err.decode("utf-8", "replace")
+
+
+class PandocBatch(object):
+    """PandocJobs run by a pool of at most max_workers background threads.
+    """
+    def __init__(self, jobs, max_workers):
+        self.jobs = jobs
+        self.max_workers = max(1, min(max_workers, len(jobs)))
+        self.cancelled = False
+        self.done_count = 0
+        self.elapsed = 0.0
+        self._pending = list(reversed(jobs))
+        self._running = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self, on_done):
+        """Start the jobs, on_done is called with the batch in the main
+        thread once they are all done, unless the batch is cancelled.
+        """
+        start = time.time()
+
+        def work():
+            while True:
+                with self._lock:
+                    if self.cancelled or not self._pending:
+                        self._running -= 1
+                        last = self._running == 0
+                        break
+                    job = self._pending.pop()
+                job.run()
+                with self._lock:
+                    self.done_count += 1
+            if last and not self.cancelled:
+                self.elapsed = time.time() - start
+                sublime.set_timeout(lambda: on_done(self), 0)
+
+        self._running = self.max_workers
+        self._threads = [threading.Thread(target=work)
+                         for i in range(self.max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def is_alive(self):
+        return len([t for t in self._threads if t.is_alive()]) > 0
+
+    def cancel(self):
+        """Kill the processes, on_done won't be called."""
+        with self._lock:
+            self.cancelled = True
+        for job in self.jobs:
+            job.cancel()
+
+    def progress(self):
+        if len(self.jobs) < 2:
+            return ""
+        return " %d/%d" % (self.done_count, len(self.jobs))
+
+
+def pandoc_command(args, target, output_name):
+    """Return the pandoc command rendering stdin to output_name.
+    """
+    cmd = ['pandoc'] + list(args)
+    # HTML is read from stdout, the other targets need a file.
+    if target != "html":
+        cmd += ["-o", output_name]
+    return cmd
+
+
+def finish_job(job, target, output_name, remove_on_error=False):
+    """Write the output of a done job, return its error or None.
+    """
+    if job.returncode == 0 and not job.err and target == "html":
+        try:
+            with open(output_name, "wb") as f:
+                f.write(job.out)
+        except (IOError, OSError) as e:
+            job.err = str(e).encode("utf-8")
+    if job.returncode == 0 and not job.err:
+        return None
+    if remove_on_error and os.path.exists(output_name):
+        os.remove(output_name)
+    return "Command: %s\n\nErrors: %s" % (" ".join(job.cmd),
+                                            job.error_text())
+
+
+def get_pandoc_version(env=None):
+    """Return the output of "pandoc --version", or None if it fails.
+
+    It's read again once the settings change, as tex_path might change the
+    pandoc which is run.
+    """
+    global _pandoc_version
+    if _pandoc_version is None:
+        try:
+            p = subprocess.Popen(["pandoc", "--version"], stdout=PIPE,
+                                 stderr=PIPE, env=env)
+            out, _ = p.communicate()
+        except OSError:
+            return None
+        if p.returncode == 0:
+            _pandoc_version = out.decode("utf-8", "replace")
+    return _pandoc_version
+
+
+class PandocSettings(object):
+    """The settings of pandoc, resolved from the package settings.
+
+    It's never changed once made, a new one is made when the settings
+    change (see get_settings).
+
+    Attributes
+    ----------
+    args: dict
+        The tuple of the arguments of pandoc, for every target.
+    env: dict
+        The environment pandoc is run in: a copy of os.environ, with the
+        "tex_path" of the settings added to the PATH for pdflatex.
+    max_workers: int
+        The number of pandoc processes run at once.
+    cache_size: int
+        The size limit of the render cache, in bytes.
+    live_preview_delay: int
+        See live_preview.
+
+    """
+    def __init__(self, setting):
+        common_args = tuple(setting.get("pandoc_args", []))
+        self.args = {
+            "pdf": common_args + tuple(setting.get("pandoc_args_pdf", [])),
+            "html": common_args + tuple(setting.get("pandoc_args_html", [])) +
+            ("-t", "html5"),
+            "docx": common_args + tuple(setting.get("pandoc_args_docx", [])) +
+            ("-t", "docx")}
+
+        self.env = dict(os.environ)
+        paths = self.env.get("PATH", "").split(os.pathsep)
+        for p in setting.get("tex_path", []):
+            if p not in paths:
+                paths.append(p)
+        self.env["PATH"] = os.pathsep.join(paths)
+
+        self.max_workers = setting.get("pandoc_max_workers", 4)
+        self.cache_size = \
+            setting.get("render_cache_size_mb", 100) * 1024 * 1024
+        self.live_preview_delay = setting.get("live_preview_delay", 500)
+
+
+def get_settings():
+    """Return the PandocSettings, resolved again only when the settings
+    change.
+    """
+    global _settings
+    if _settings is None:
+        setting = sublime.load_settings("SmartMarkdown.sublime-settings")
+        setting.clear_on_change("pandoc_render")
+        setting.add_on_change("pandoc_render", _reset_settings)
+        _settings = PandocSettings(setting)
+    return _settings
+
+
+def _reset_settings():
+    global _settings, _pandoc_version
+    _settings = None
+    _pandoc_version = None
+
+
+class PandocRenderListener(sublime_plugin.EventListener):
+    """Remove the temporary outputs of a view when it's closed."""
+    def on_close(self, view):
+        cancel_job(view)
+        if view.id() not in _temp_output_views:
+            return
+        _temp_output_views.discard(view.id())
+        for target in ("html", "docx", "pdf"):
+            output_name = get_temp_output_name(view, "." + target,
+                                               create=False)
+            if os.path.exists(output_name):
+                try:
+                    os.remove(output_name)
+                except OSError:
+                    pass
+
+
+def get_temp_output_name(view, suffix, create=True):
+    """Return the path of the temporary output of view for suffix.
+
+    Unless create is False, its directory is created and the output is
+    removed once the view is closed.
+    """
+    directory = os.path.join(tempfile.gettempdir(), "SmartMarkdown")
+    if create:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _temp_output_views.add(view.id())
+    return os.path.join(directory, "view-%d%s" % (view.id(), suffix))
+
+
+def cancel_job(view):
+    """Cancel the render in progress of view, return if there was one.
+    """
+    job = _jobs.pop(view.id(), None)
+    if job is None:
+        return False
+    job.cancel()
+    view.erase_status("pandoc")
+    return True
+
+
+def start_job(view, job, label, on_done):
+    """Start the job (a PandocBatch) as the render of view, superseding the
+    one in progress.
+
+    The progress is shown in the status bar until the job is done.
+    """
+    view_id = view.id()
+    cancel_job(view)
+    _jobs[view_id] = job
+
+    def done(job):
+        if _jobs.get(view_id) is not job:
+            return
+        del _jobs[view_id]
+        view.erase_status("pandoc")
+        on_done(job)
+    job.start(done)
+    _show_progress(view, job, label)
+
+
+def _show_progress(view, job, label, i=0):
+    if _jobs.get(view.id()) is not job or not job.is_alive():
+        return
+    before = i % 8
+    view.set_status("pandoc", "%s%s [%s=%s]" % (label, job.progress(),
+                                                " " * before,
+                                                " " * (7 - before)))
+    sublime.set_timeout(lambda: _show_progress(view, job, label, i + 1), 100)
@@ -0,0 +1,139 @@
+"""A bounded on-disk cache of rendered files, addressed by content.
+
+Terminologies
+
+- Key :: The hash of everything a render depends on (the source, the target,
+the arguments of pandoc, its version...), so that a render can be reused as
+long as none of them has changed.
+
+The least recently used files are evicted once the cache gets bigger than
+its size limit.
+"""
+# LICENSE: MIT
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+import sublime
+
+# Serializes the changes of the cache directories, which are shared by the
+# renders running in the background.
+_lock = threading.Lock()
+
+
+def get_cache_dir(name):
+    """Return the path of the cache directory name of the package."""
+    try:
+        cache_path = sublime.cache_path()
+    except AttributeError:
+        # Sublime Text 2 has no cache path.
+        cache_path = tempfile.gettempdir()
+    return os.path.join(cache_path, "SmartMarkdown", name)
+
+
+def make_key(*parts):
+    """Return the key of parts, which are str, bytes, or lists of them."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = "\0".join(part)
+        if not isinstance(part, bytes):
+            part = part.encode("utf-8")
+        digest.update(str(len(part)).encode("ascii") + b":" + part)
+    return digest.hexdigest()
+
+
+def write_file(file_name, data):
+    """Write data (bytes) to file_name, so that it's never read half written.
+
+    The data is written aside first, then moved over file_name.
+    """
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, "wb") as f:
+        f.write(data)
+    replace_file(tmp_name, file_name)
+
+
+def replace_file(src, dst):
+    """Move the file src over dst, in one step where the platform allows it.
+
+    Python 2 (Sublime Text 2) has no os.replace, and its os.rename doesn't
+    overwrite a file on Windows, so dst is removed first there.
+    """
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class RenderCache(object):
+    """The rendered files in directory, up to max_size bytes in total.
+
+    A max_size of 0 disables the cache.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key, suffix):
+        """Return the path of the file cached for key, or None.
+
+        The file is marked as used, so it's the last one to be evicted.
+        """
+        if self.max_size <= 0:
+            return None
+        path = self._path(key, suffix)
+        with _lock:
+            try:
+                os.utime(path, None)
+            except OSError:
+                return None
+        return path
+
+    def put(self, key, suffix, file_name):
+        """Cache a copy of the file file_name for key, and return its path.
+        """
+        if self.max_size <= 0 or os.path.getsize(file_name) > self.max_size:
+            return None
+        path = self._path(key, suffix)
+        with _lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = path + ".tmp"
+            shutil.copyfile(file_name, tmp_path)
+            replace_file(tmp_path, path)
+            self._evict()
+        return path
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
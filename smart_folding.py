@@ -15,10 +15,10 @@ import sublime_plugin
 
 try:
     from . import headline
-    from .utilities import is_region_void
+    from .utilities import FoldedRegions
 except ValueError:
     import headline
-    from utilities import is_region_void
+    from utilities import FoldedRegions
 
 
 HEADLINE_PATTERN = re.compile(r'^(#+)\s.*')
@@ -30,9 +30,10 @@ class SmartNewLineCommand(sublime_plugin.TextCommand):
     """
     def run(self, edit):
         points = []
+        folds = FoldedRegions.of_view(self.view)
         for s in self.view.sel():
             r = self.view.full_line(s)
-            if headline._is_region_folded(r.b + 1, self.view):
+            if folds.contains(r.b + 1):
                 i = headline.region_of_content_of_headline_at_point(self.view, s.b)
             else:
                 i = sublime.Region(r.a, r.b - 1)
@@ -81,43 +82,40 @@ class SmartFoldingCommand(sublime_plugin.TextCommand):
             return True
 
         # Check if content region is folded to decide the action.
-        if self.is_region_totally_folded(content_region):
+        folds = FoldedRegions.of_view(self.view)
+        if self.is_region_totally_folded(content_region, folds):
             self.unfold_yet_fold_subheads(content_region, level)
         else:
             self.view.fold(sublime.Region(content_region.a - 1, content_region.b))
         return True
 
-    def is_region_totally_folded(self, region):
-        """Decide if the region is folded. Treat empty region as folded."""
+    def is_region_totally_folded(self, region, folds=None):
+        """Decide if the region is folded. Treat empty region as folded.
+
+        folds is the FoldedRegions snapshot to check against, taken from
+        the view if not given.
+
+        """
         if (region is None) or (region.a == region.b):
             return True
 
-        for i in self.view.folded_regions():
-            if i.contains(region):
-                return True
-        return False
+        if folds is None:
+            folds = FoldedRegions.of_view(self.view)
+        return folds.contains(region)
 
     def unfold_yet_fold_subheads(self, region, level):
-        """Unfold the region while keeping the subheadlines folded."""
+        """Unfold the region while keeping the subheadlines folded.
+
+        All the subheadlines are at a lower level than level, the regions
+        of their content are computed at once and folded in one call.
+
+        """
         ## First unfold all
         self.view.unfold(region)
         ## Fold subheads
-        child_headline_region, _ = headline.find_headline(self.view, region.a, level, True, \
-                                                          headline.MATCH_CHILD)
-
-        while (not is_region_void(child_headline_region) and child_headline_region.b <= region.b):
-            child_content_region = headline.region_of_content_of_headline_at_point(self.view,
-                                                                                   child_headline_region.a)
-            if child_content_region is not None:
-                self.view.fold(sublime.Region(child_content_region.a - 1, child_content_region.b))
-                search_start_point = child_content_region.b
-            else:
-                search_start_point = child_headline_region.b
-
-            child_headline_region, _ = headline.find_headline(self.view, \
-                                                              search_start_point, level, True, \
-                                                              headline.MATCH_CHILD,
-                                                              skip_headline_at_point=True)
+        self.view.fold([sublime.Region(r.a - 1, r.b) for r in
+                        headline.regions_of_content_of_headlines(self.view,
+                                                                 region)])
 
 
 class GlobalFoldingCommand(SmartFoldingCommand):
@@ -136,75 +134,42 @@ class GlobalFoldingCommand(SmartFoldingCommand):
 
     def is_global_folded(self):
         """Check if all headlines are folded.
-        """
-        region, level = headline.find_headline(self.view, 0, \
-                                               headline.ANY_LEVEL, True)
-        # Treating no heeadline as folded, since unfolded all makes
-        # no harm in this situation.
-        if is_region_void(region):
-            return True
 
-        point = region.a
-        # point can be zero
-        while (point is not None and region):
-            region = headline.region_of_content_of_headline_at_point(self.view, \
-                                                                     point)
-            if not is_region_void(region):
-                point = region.b
-            if not self.is_region_totally_folded(region):
-                return False
-            else:
-                region, level = headline.find_headline(self.view, point, \
-                                                       headline.ANY_LEVEL, \
-                                                       True,
-                                                       skip_headline_at_point=True)
-                if not is_region_void(region):
-                    point = region.a
-        return True
+        Treating no headline as folded, since unfolded all makes
+        no harm in this situation.
+        """
+        folds = FoldedRegions.of_view(self.view)
+        return folds.contains_all(
+            headline.regions_of_content_of_headlines(self.view))
 
     def unfold_all(self):
         self.view.unfold(sublime.Region(0, self.view.size()))
         self.view.show(self.view.sel()[0])
 
     def fold_all(self):
-        region, level = headline.find_headline(self.view, \
-                                               0, \
-                                               headline.ANY_LEVEL, \
-                                               True)
-
-        # At this point, headline region is sure to exist, otherwise it would be
-        # treated as gobal folded. (self.is_global_folded() would return True)
-        point = region.a
-        # point can be zero
-        while (point is not None and region):
-            region = headline.region_of_content_of_headline_at_point(self.view, \
-                                                                     point)
-            if not is_region_void(region):
-                point = region.b
-                self.view.fold(sublime.Region(region.a - 1, region.b))
-            region, level = headline.find_headline(self.view, point, \
-                                                   headline.ANY_LEVEL,
-                                                   True, \
-                                                   skip_headline_at_point=True)
-            if not is_region_void(region):
-                point = region.a
-        self.adjust_cursors_and_view()
-
-    def adjust_cursors_and_view(self):
+        regions = [sublime.Region(r.a - 1, r.b) for r in
+                   headline.regions_of_content_of_headlines(self.view)]
+        self.view.fold(regions)
+        self.adjust_cursors_and_view(FoldedRegions(regions))
+
+    def adjust_cursors_and_view(self, folds=None):
         """After folder, adjust cursors and view.
 
         If the current point is inside the folded region, move it move
         otherwise it's easy to perform some unintentional editing.
 
+        folds is the FoldedRegions of the folding just done, taken from the
+        view if not given.
+
         """
-        folded_regions = self.view.folded_regions()
+        if folds is None:
+            folds = FoldedRegions.of_view(self.view)
         new_sel = []
 
         for r in self.view.sel():
-            for folded in folded_regions:
-                if folded.contains(r):
-                    new_sel.append(sublime.Region(folded.b, folded.b))
-                    break
+            folded_end = folds.fold_end(r)
+            if folded_end is not None:
+                new_sel.append(sublime.Region(folded_end, folded_end))
             else:
                 new_sel.append(r)
 
@@ -6,6 +6,11 @@ import re
 import sublime
 import sublime_plugin
 
+try:
+    from .utilities import FoldedRegions
+except ValueError:
+    from utilities import FoldedRegions
+
 
 ORDER_LIST_PATTERN = re.compile(r"(\s*)(\d+)(\.\s+)\S+")
 UNORDER_LIST_PATTERN = re.compile(r"(\s*[-+\**]+)(\s+)\S+")
@@ -14,7 +19,10 @@ EMPTY_LIST_PATTERN = re.compile(r"(\s*([-+\**]|\d+\.+))\s+$")
 
 class SmartListCommand(sublime_plugin.TextCommand):
     def run(self, edit):
-        for region in self.view.sel():
+        folds = FoldedRegions.of_view(self.view)
+        # Every cursor continues its own list, from the bottom up so that the
+        # points above are still good.
+        for region in reversed(list(self.view.sel())):
             line_region = self.view.line(region)
             # the content before point at the current line.
             before_point_region = sublime.Region(line_region.a,
@@ -22,18 +30,14 @@ class SmartListCommand(sublime_plugin.TextCommand):
             before_point_content = self.view.substr(before_point_region)
 
             # Disable smart list when folded.
-            folded = False
-            for i in self.view.folded_regions():
-                if i.contains(before_point_region):
-                    self.view.insert(edit, region.a, '\n')
-                    folded = True
-            if folded:
-                break
+            if folds.contains(before_point_region):
+                self.view.insert(edit, region.a, '\n')
+                continue
 
             match = EMPTY_LIST_PATTERN.match(before_point_content)
             if match:
                 self.view.erase(edit, before_point_region)
-                break
+                continue
 
             match = ORDER_LIST_PATTERN.match(before_point_content)
             if match:
@@ -41,13 +45,13 @@ class SmartListCommand(sublime_plugin.TextCommand):
                               str(int(match.group(2)) + 1) + \
                               match.group(3)
                 self.view.insert(edit, region.a, "\n" + insert_text)
-                break
+                continue
 
             match = UNORDER_LIST_PATTERN.match(before_point_content)
             if match:
                 insert_text = match.group(1) + match.group(2)
                 self.view.insert(edit, region.a, "\n" + insert_text)
-                break
+                continue
 
             self.view.insert(edit, region.a, '\n')
         self.adjust_view()
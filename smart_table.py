@@ -2,51 +2,115 @@
 
 Markdown itself doesn't support grid table, yet pandoc does.
 
+With "smart_table_lazy_align" set, TAB only moves between the cells of a
+table and marks it dirty. The dirty tables are realigned at once when the
+typing stops for "smart_table_align_delay" milliseconds, or when the cursor
+leaves them.
+
 @todo: add a key binding for converting grid table to the simple one
 """
 # Author: Muchenxuan Tong <demon386@gmail.com>
 # LICENSE: MIT
 
+import threading
+
 import sublime
 import sublime_plugin
 
 try:
     from . import table
+    from .utilities import FoldedRegions
 except ValueError:
     import table
+    from utilities import FoldedRegions
+
+SETTINGS_FILE = "SmartMarkdown.sublime-settings"
+DIRTY_TABLES_KEY = "smart_table_dirty"
+
+# Generation of the pending realignment of every view, keyed by view id.
+_realign_generations = {}
+
+# Views bigger than this have their tables aligned in the background.
+_ALIGN_ALL_IN_BACKGROUND_SIZE = 1 << 20
+# Tables reformatted in the background, with the change count of the view
+# they were read at, keyed by view id.
+_reformatted_tables = {}
 
 
 class SmartTable(sublime_plugin.TextCommand):
     def run(self, edit, forward=True):
+        settings = sublime.load_settings(SETTINGS_FILE)
+        lazy = settings.get("smart_table_lazy_align", False)
+        sel = list(self.view.sel())
         new_sel = []
-        for r in self.view.sel():
-            point = r.a
+        dirty_lines = []
+        folds = FoldedRegions.of_view(self.view)
 
-            for i in self.view.folded_regions():
-                if i.contains(sublime.Region(point, point)):
-                    return
-            t = table.convert_table_at_point_as_list(self.view, point)
-            t = table.reformat_table_list(t)
-            t_str = table.convert_table_list_to_str(t)
+        # From the bottom up, so that the points above are still good. The
+        # cursors of a table are moved together, with one realignment.
+        i = len(sel)
+        while i > 0:
+            i -= 1
+            point = sel[i].a
 
-            # Both are 0-based
-            cur_row_num, cur_col_num = table.get_point_row_and_col(self.view, point)
-            table_row_num = len(t)
-            line_num, _ = self.view.rowcol(point)
-            start_line_num = line_num - cur_row_num
-            start_point = self.view.text_point(line_num - cur_row_num, 0)
-            end_line_num = line_num + table_row_num - cur_row_num - 1
-            end_line_start_point = self.view.text_point(end_line_num, 0)
-            end_point = self.view.line(end_line_start_point).b
-
-            # Erase the previous table region, use the new one for substitution.
-            self.view.erase(edit, sublime.Region(start_point, end_point))
-            self.view.insert(edit, start_point, t_str)
+            # Disable smart table when folded.
+            if folds.contains(point):
+                new_sel.append(sel[i])
+                continue
+            if lazy:
+                line = self.view.line(point)
+                new_point = self.move_lazily(line, point, forward)
+                if new_point is not None:
+                    dirty_lines.append(line)
+                    new_sel.append(new_point)
+                    continue
+
+            table_at_point = table.TableAtPoint(self.view, point)
+            points = [point]
+            while i > 0 and sel[i - 1].a >= table_at_point.region.a:
+                i -= 1
+                if folds.contains(sel[i].a):
+                    new_sel.append(sel[i])
+                else:
+                    points.append(sel[i].a)
+            new_points, size_change = self.align_and_move(
+                edit, table_at_point, points, forward)
+            # The cursors below are shifted by the realignment.
+            new_sel = [shift(r, size_change) for r in new_sel] + new_points
 
+        if dirty_lines:
+            mark_tables_dirty(self.view, dirty_lines)
+            schedule_realign(self.view,
+                             settings.get("smart_table_align_delay", 1000))
+
+        self.view.sel().clear()
+        for r in new_sel:
+            self.view.sel().add(r)
+            self.view.show(r)
+
+    def align_and_move(self, edit, table_at_point, points, forward):
+        """Realign the table, and return where its points move together with
+        the change of size of the view.
+        """
+        t = table.reformat_table_list(table_at_point.table)
+        new_lines = table.convert_table_list_to_str(t).split("\n")
+        region = table_at_point.region
+        start_line_num, _ = self.view.rowcol(region.a)
+        end_line_num = start_line_num + len(t) - 1
+
+        # Only the lines which changed are replaced.
+        table_at_point.rewrite(self.view, edit, new_lines)
+        size_change = len("\n".join(new_lines)) - region.size()
+
+        rows_and_cols = []
+        for point in points:
+            # Both are 0-based
+            cur_row_num, cur_col_num = table_at_point.get_row_and_col(point)
+            line_num = start_line_num + cur_row_num
             if forward:
                 if cur_col_num is None or cur_col_num >= len(t[0]) - 1:
                     line_num += 1
-                    while(table.is_line_separator(self.view, line_num)):
+                    while(table_at_point.is_separator(line_num - start_line_num)):
                         line_num += 1
                     cur_col_num = 0
                 else:
@@ -54,26 +118,61 @@ class SmartTable(sublime_plugin.TextCommand):
             else:
                 if cur_col_num is None or cur_col_num <= 0:
                     line_num -= 1
-                    while(table.is_line_separator(self.view, line_num)):
+                    while(table_at_point.is_separator(line_num - start_line_num)):
                         line_num -= 1
                     cur_col_num = len(t[0]) - 1
                 else:
                     cur_col_num -= 1
 
-            # Add a new line when at the end of the table.
             if line_num < start_line_num or line_num > end_line_num:
                 col_pos = 0
-                if line_num > end_line_num:
-                    self.view.insert(edit, self.view.text_point(line_num, 0), "\n")
             else:
                 col_pos = self.calculate_col_point(t, cur_col_num)
+            rows_and_cols.append((line_num, col_pos))
 
-            new_sel.append(self.view.text_point(line_num, col_pos))
+        # Add a new line when at the end of the table.
+        if [line_num for (line_num, _) in rows_and_cols
+                if line_num > end_line_num]:
+            self.view.insert(edit, self.view.text_point(end_line_num + 1, 0),
+                             "\n")
+            size_change += 1
 
-        self.view.sel().clear()
-        for r in new_sel:
-            self.view.sel().add(r)
-            self.view.show(r)
+        new_points = [self.view.text_point(line_num, col_pos)
+                      for (line_num, col_pos) in rows_and_cols]
+        return (new_points, size_change)
+
+    def move_lazily(self, line, point, forward):
+        """Return where the point moves, without realigning the table.
+
+        Only the line at point is read, and the next or previous rows when the
+        point leaves its row. None is returned when it leaves the table.
+
+        """
+        text = self.view.substr(line)
+        cols_start = table.get_cols_start(text)
+        col_num = text[:point - line.a].count("|") - 1
+        if forward and col_num + 1 < len(cols_start):
+            return line.a + cols_start[col_num + 1]
+        if not forward and col_num > 0 and cols_start:
+            return line.a + cols_start[min(col_num, len(cols_start)) - 1]
+
+        # Move to the first (or last) column of the next (or previous) row.
+        while True:
+            if forward:
+                next_line = self.view.line(line.b + 1)
+                if next_line.a <= line.b:
+                    return None
+            else:
+                if line.a == 0:
+                    return None
+                next_line = self.view.line(line.a - 1)
+            line = next_line
+            text = self.view.substr(line)
+            if not table.is_table_line(text):
+                return None
+            cols_start = table.get_cols_start(text)
+            if cols_start:
+                return line.a + cols_start[0 if forward else -1]
 
     def calculate_col_point(self, formatted_table, col_num):
         i = 0
@@ -85,3 +184,256 @@ class SmartTable(sublime_plugin.TextCommand):
         for i in range(col_num):
             point += cols_length[i] + 3
         return point
+
+
+class SmartTableRealignCommand(sublime_plugin.TextCommand):
+    """Realign the tables marked dirty by SmartTable.
+    """
+    def run(self, edit):
+        _realign_generations.pop(self.view.id(), None)
+        dirty_lines = self.view.get_regions(DIRTY_TABLES_KEY)
+        self.view.erase_regions(DIRTY_TABLES_KEY)
+
+        tables = []
+        for line in dirty_lines:
+            if tables and line.a <= tables[-1][0].b:
+                continue
+            table_at_point = table.TableAtPoint(self.view, line.a)
+            lines = table_at_point.lines
+            if not table.is_table_line(lines[table_at_point.row_num]):
+                continue
+            tables.append((table_at_point.region, lines,
+                           table.reformat_table_lines(lines)))
+        rewrite_tables(self.view, edit, [(region.a, lines, new_lines)
+                                         for (region, lines, new_lines)
+                                         in tables])
+
+
+class SmartTableAlignAllCommand(sublime_plugin.TextCommand):
+    """Realign every grid table of the view in one edit.
+
+    The tables of a big view are reformatted in a background thread, and
+    written back unless the view has changed in the meantime.
+
+    """
+    def run(self, edit):
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        if len(text) < _ALIGN_ALL_IN_BACKGROUND_SIZE:
+            rewrite_tables(self.view, edit, _reformat_tables(text))
+            return
+
+        view = self.view
+        view_id = view.id()
+        change_count = view.change_count()
+
+        def reformat():
+            _reformatted_tables[view_id] = (change_count,
+                                            _reformat_tables(text))
+            sublime.set_timeout(
+                lambda: view.run_command("smart_table_rewrite_all"), 0)
+        sublime.status_message("Aligning the tables...")
+        threading.Thread(target=reformat).start()
+
+
+class SmartTableRewriteAllCommand(sublime_plugin.TextCommand):
+    """Write back the tables reformatted by SmartTableAlignAllCommand.
+    """
+    def run(self, edit):
+        change_count, tables = _reformatted_tables.pop(self.view.id(),
+                                                       (None, []))
+        if change_count != self.view.change_count():
+            sublime.status_message("The tables weren't aligned, "
+                                   "the view has changed.")
+            return
+        rewrite_tables(self.view, edit, tables)
+        sublime.status_message("%d tables aligned." % len(tables))
+
+
+class SmartTableInsertColumnCommand(sublime_plugin.TextCommand):
+    """Insert an empty column before the column at point.
+    """
+    def run(self, edit):
+        def insert_column(t, row_num, col_num):
+            return (table.insert_column(t, col_num), row_num, col_num)
+        edit_table_at_point(self.view, edit, insert_column)
+
+
+class SmartTableDeleteColumnCommand(sublime_plugin.TextCommand):
+    """Delete the column at point.
+    """
+    def run(self, edit):
+        def delete_column(t, row_num, col_num):
+            return (table.delete_column(t, col_num), row_num,
+                    max(col_num - 1, 0))
+        edit_table_at_point(self.view, edit, delete_column)
+
+
+class SmartTableMoveColumnCommand(sublime_plugin.TextCommand):
+    """Swap the column at point with the next (or previous) one.
+    """
+    def run(self, edit, forward=True):
+        def move_column(t, row_num, col_num):
+            return (table.move_column(t, col_num, forward), row_num,
+                    col_num + 1 if forward else col_num - 1)
+        edit_table_at_point(self.view, edit, move_column)
+
+
+class SmartTableMoveRowCommand(sublime_plugin.TextCommand):
+    """Swap the row at point with the next (or previous) one.
+    """
+    def run(self, edit, forward=True):
+        def move_row(t, row_num, col_num):
+            return (table.move_row(t, row_num, forward),
+                    row_num + 1 if forward else row_num - 1, col_num)
+        edit_table_at_point(self.view, edit, move_row, needs_col=False)
+
+
+class SmartTableSortCommand(sublime_plugin.TextCommand):
+    """Sort the rows of the table by the column at point.
+    """
+    def run(self, edit, reverse=False):
+        def sort_rows(t, row_num, col_num):
+            return (table.sort_rows(t, col_num, reverse), row_num, col_num)
+        edit_table_at_point(self.view, edit, sort_rows)
+
+
+class SmartTableListener(sublime_plugin.EventListener):
+    """Realign the dirty tables when the typing stops or the cursor leaves them.
+    """
+    def on_modified(self, view):
+        if view.id() in _realign_generations:
+            settings = sublime.load_settings(SETTINGS_FILE)
+            schedule_realign(view, settings.get("smart_table_align_delay", 1000))
+
+    def on_selection_modified(self, view):
+        if view.id() not in _realign_generations:
+            return
+        sel = view.sel()
+        if len(sel) > 0 and \
+                not table.is_table_line(view.substr(view.line(sel[0].b))):
+            view.run_command("smart_table_realign")
+
+    def on_close(self, view):
+        _realign_generations.pop(view.id(), None)
+
+
+def shift(region_or_point, offset):
+    """Return the region (or point) moved by offset.
+    """
+    if isinstance(region_or_point, sublime.Region):
+        return sublime.Region(region_or_point.a + offset,
+                              region_or_point.b + offset)
+    return region_or_point + offset
+
+
+def rewrite_tables(view, edit, tables):
+    """Replace the changed lines of the tables, keeping the cursors in their
+    cells.
+
+    tables is a list of (start, lines, new_lines) from the top down, the
+    points being those before any table is rewritten.
+
+    """
+    # A table keeps its lines when it's rewritten, so the cursors are kept as
+    # (row, col) and moved within their rows.
+    selection = list(view.sel())
+    sel = [(view.rowcol(r.a), view.rowcol(r.b)) for r in selection]
+    points = [p for r in selection for p in (r.a, r.b)]
+    realigned_rows = {}
+    for (start, lines, new_lines) in tables:
+        end = start + len("\n".join(lines))
+        if not [p for p in points if start <= p <= end]:
+            continue
+        start_row, _ = view.rowcol(start)
+        for (i, line_text) in enumerate(lines):
+            if line_text != new_lines[i]:
+                realigned_rows[start_row + i] = (line_text, new_lines[i])
+
+    # From the bottom up, so that the points above are still good.
+    for (start, lines, new_lines) in reversed(tables):
+        changed_lines = table.get_changed_lines(start, lines, new_lines)
+        for (begin, end, text) in reversed(changed_lines):
+            view.replace(edit, sublime.Region(begin, end), text)
+    if not realigned_rows:
+        return
+
+    def realigned_point(row_col):
+        row, col = row_col
+        if row in realigned_rows:
+            col = table.get_realigned_col(realigned_rows[row][0],
+                                          realigned_rows[row][1], col)
+        return view.text_point(row, col)
+
+    view.sel().clear()
+    for (a, b) in sel:
+        view.sel().add(sublime.Region(realigned_point(a), realigned_point(b)))
+
+
+def edit_table_at_point(view, edit, operation, needs_col=True):
+    """Apply operation to the table list at the first cursor, and write the
+    table back realigned.
+
+    operation is called with the table list, the row and the col of the
+    cursor, and returns the new table list (None for leaving the table as
+    it is) with the row and col to move the cursor to.
+
+    """
+    point = view.sel()[0].b
+    table_at_point = table.TableAtPoint(view, point)
+    row_num, col_num = table_at_point.row_num, table_at_point.col_num
+    if not table.is_table_line(table_at_point.lines[row_num]):
+        return
+    if needs_col and (col_num is None or col_num < 0):
+        sublime.status_message("The cursor isn't in a column of the table.")
+        return
+
+    new_table, row_num, col_num = operation(table_at_point.table,
+                                            row_num, col_num)
+    if new_table is None:
+        return
+    t = table.reformat_table_list(new_table)
+    new_lines = table.convert_table_list_to_str(t).split("\n")
+    table_at_point.rewrite(view, edit, new_lines)
+
+    new_point = table_at_point.region.a + sum([len(line) + 1 for line
+                                               in new_lines[:row_num]])
+    cols_start = table.get_cols_start(new_lines[row_num])
+    if col_num is not None and cols_start:
+        new_point += cols_start[min(max(col_num, 0), len(cols_start) - 1)]
+    view.sel().clear()
+    view.sel().add(sublime.Region(new_point))
+    view.show(new_point)
+
+
+def _reformat_tables(text):
+    """Return (start, lines, new_lines) for every grid table of text which
+    isn't aligned.
+    """
+    tables = []
+    for (start, lines) in table.find_grid_tables(text):
+        new_lines = table.reformat_table_lines(lines)
+        if new_lines != lines:
+            tables.append((start, lines, new_lines))
+    return tables
+
+
+def mark_tables_dirty(view, lines):
+    """Mark the tables of the lines as to be realigned.
+    """
+    view.add_regions(DIRTY_TABLES_KEY,
+                     view.get_regions(DIRTY_TABLES_KEY) + lines,
+                     "", "", sublime.HIDDEN)
+
+
+def schedule_realign(view, delay):
+    """Realign the dirty tables of view after delay, unless it's scheduled
+    again in the meantime.
+    """
+    view_id = view.id()
+    generation = _realign_generations.get(view_id, 0) + 1
+    _realign_generations[view_id] = generation
+
+    def realign():
+        if _realign_generations.get(view_id) == generation:
+            view.run_command("smart_table_realign")
+    sublime.set_timeout(realign, delay)
@@ -9,8 +9,9 @@ a nested python list. Each row is a sub-list in the table list.
 # Author: Muchenxuan Tong <demon386@gmail.com>
 # LICENSE: MIT
 
+import os.path
 import re
-import copy
+import bisect
 
 import sublime
 
@@ -21,62 +22,220 @@ except ValueError:
 
 TABLE_PATTERN = re.compile(r"\s*\|")
 SEPARATOR_PATTERN = re.compile(r"\s*(\+[=-])")
+# For view.find: the newline ending the last line of a table.
+TABLE_END_PATTERN = r"\n(?![^\S\n]*(?:\||\+[=-]))"
+LIST_ITEM_PATTERN = re.compile(r"[ ]{0,3}(?:[-+*]|\d+[.)])[ \t]")
+INDENT_PATTERN = re.compile(r"[ \t]*")
 
 
-def convert_table_at_point_as_list(view, from_point):
-    """Get the table at the point.
-    Transform the table to python list.
+class TableAtPoint(object):
+    """The table around a point, found and read from the view at once.
+
+    The end of the table is found with one view.find, and the lines above
+    the point are read with utilities.lines_above.
+
+    Attributes
+    ----------
+    region: sublime.Region
+        The region spanning the lines of the table.
+    lines: list
+        The text of every line of the table.
+    table: list
+        The table list.
+    row_num: int
+        The row the point is in, 0-based.
+    col_num: int or None
+        The column the point is in, 0-based: -1 before the first '|' of a
+        row, None out of the columns (see _get_col_num).
+
+    """
+    def __init__(self, view, from_point):
+        end = view.find(TABLE_END_PATTERN, from_point).a
+        if end < 0:
+            end = view.size()
+
+        above = utilities.lines_above(view, from_point, is_table_line)
+        below = view.substr(sublime.Region(from_point, end)).split("\n")
+
+        self.region = sublime.Region(from_point - len("\n".join(above)), end)
+        self.lines = above[:-1] + [above[-1] + below[0]] + below[1:]
+        self.table = [_convert_row_text_as_list(line) for line in self.lines]
+        self.row_num = len(above) - 1
+        self.col_num = _get_col_num(above[-1])
+        self._line_starts = None
+
+    def get_row_and_col(self, point):
+        """Return the row and col a point of the table is in, as row_num
+        and col_num.
+        """
+        if self._line_starts is None:
+            self._line_starts = [self.region.a]
+            for line in self.lines[:-1]:
+                self._line_starts.append(self._line_starts[-1] + len(line) + 1)
+        row_num = max(bisect.bisect_right(self._line_starts, point) - 1, 0)
+        line_start = self._line_starts[row_num]
+        return (row_num, _get_col_num(self.lines[row_num][:point - line_start]))
+
+    def rewrite(self, view, edit, new_lines):
+        """Replace the lines of the table which differ from new_lines.
+
+        Every run of changed lines is replaced at once, from the bottom up so
+        that the offsets of the lines above are still good. Nothing is done
+        when the table is unchanged, so an aligned table isn't touched and
+        doesn't get into the undo history.
+
+        """
+        changed_lines = get_changed_lines(self.region.a, self.lines, new_lines)
+        for (begin, end, text) in reversed(changed_lines):
+            view.replace(edit, sublime.Region(begin, end), text)
+
+    def is_separator(self, row_num):
+        """Check if the row is a separator, rows out of the table aren't.
+        """
+        return 0 <= row_num < len(self.lines) and \
+            SEPARATOR_PATTERN.match(self.lines[row_num]) is not None
+
+
+def get_changed_lines(start, lines, new_lines):
+    """Compare the lines of a table with new_lines, of the same number.
+
+    Parameters
+    ----------
+    start: int
+        The point where the first line starts.
 
     Returns
     -------
-    table: list
-        A nested list representing the table.
-    indent: "str" (@todo not impelmented yet)
-        String of indentation, used in every row.
+    changes: list
+        (begin, end, text) for every run of changed lines, from the top down,
+        text being the new lines of the run.
 
     """
-    table_above = convert_table_above_or_below_as_list(view, from_point, above=True)
-    table_below = convert_table_above_or_below_as_list(view, from_point, above=False)
-    row_at_point = convert_row_at_point_as_list(view, from_point)
+    changes = []
+    begin = start
+    row_num = 0
+    while row_num < len(lines):
+        if lines[row_num] == new_lines[row_num]:
+            begin += len(lines[row_num]) + 1
+            row_num += 1
+            continue
+        first_row_num = row_num
+        end = begin + len(lines[row_num])
+        row_num += 1
+        while row_num < len(lines) and lines[row_num] != new_lines[row_num]:
+            end += len(lines[row_num]) + 1
+            row_num += 1
+        changes.append((begin, end,
+                        "\n".join(new_lines[first_row_num:row_num])))
+        begin = end + 1
+    return changes
 
-    table = table_above + [row_at_point] + table_below
-    return table
 
+def find_grid_tables(text):
+    """Find every grid table in text, outside of code blocks.
 
-def convert_table_above_or_below_as_list(view, from_point, above):
-    """Convert the table above the point as python list.
+    A grid table is a block of table lines starting with a separator, so that
+    the pipe tables are left alone. Lines indented by 4 spaces or more are
+    an indented code block, unless they follow a list item (a list ends at
+    a line which isn't indented, after a blank line).
 
     Returns
     -------
-    table: list
-        A nested list representing the table.
+    tables: list
+        (start, lines) for every table, start being where its first line
+        starts in text.
 
     """
-    line_num, _ = view.rowcol(from_point)
-    line_num += - 1 if above else 1
+    tables = []
+    fence = None
+    in_list = False
+    after_blank = False
+    block_start = 0
+    block = []
+    offset = 0
+    for line_text in text.split("\n"):
+        indent = len(INDENT_PATTERN.match(line_text).group().expandtabs(4))
+        blank = indent == len(line_text)
+        is_code = fence is not None or (indent >= 4 and not in_list)
+        if not is_code and is_table_line(line_text):
+            if not block:
+                block_start = offset
+            block.append(line_text)
+        else:
+            if block and SEPARATOR_PATTERN.match(block[0]):
+                tables.append((block_start, block))
+            block = []
+            match = utilities.FENCE_PATTERN.match(line_text)
+            if match is not None:
+                fence = utilities.next_fence(fence, *match.groups())
+        if fence is None and not blank:
+            if LIST_ITEM_PATTERN.match(line_text):
+                in_list = True
+            elif after_blank and indent == 0:
+                in_list = False
+        after_blank = blank
+        offset += len(line_text) + 1
+    if block and SEPARATOR_PATTERN.match(block[0]):
+        tables.append((block_start, block))
+    return tables
+
+
+def reformat_table_lines(lines):
+    """Reformat & align the lines of a table, return the new lines.
+
+    The indentation common to the lines is kept, as in a table of a list.
+    """
+    indent = os.path.commonprefix([INDENT_PATTERN.match(line).group()
+                                   for line in lines])
+    t = reformat_table_list([_convert_row_text_as_list(line) for line in lines])
+    return [indent + line for line in convert_table_list_to_str(t).split("\n")]
 
-    line_text = utilities.text_at_line(view, line_num)
-    table = []
 
-    while line_text and (TABLE_PATTERN.match(line_text) or
-                         SEPARATOR_PATTERN.match(line_text)):
-        table.append(_convert_row_text_as_list(line_text))
-        line_num += -1 if above else 1
-        line_text = utilities.text_at_line(view, line_num)
+def is_table_line(line_text):
+    """Check if the line is a row or a separator of a table.
+    """
+    return bool(line_text) and (TABLE_PATTERN.match(line_text) is not None or
+                                SEPARATOR_PATTERN.match(line_text) is not None)
 
-    if above:
-        table = table[::-1]
 
-    return table
+def get_cols_start(row_text):
+    """Return where the text of every column starts in the row.
 
+    It's read from the '|' of the row only, so it works on a row which isn't
+    aligned. A separator has no column.
 
-def convert_row_at_point_as_list(view, from_point):
-    """Convert the row at point as a python list.
     """
-    line_num, _ = view.rowcol(from_point)
-    line_text = utilities.text_at_line(view, line_num)
+    pipes = [i for (i, char) in enumerate(row_text) if char == "|"]
+    if len(pipes) > 1 and row_text[pipes[-1] + 1:].strip() == "":
+        pipes.pop()
+    return [i + 2 if row_text[i + 1:i + 2] == " " else i + 1 for i in pipes]
 
-    return _convert_row_text_as_list(line_text)
+
+def get_realigned_col(row_text, new_row_text, col):
+    """Return where col of row_text is once the row is realigned as new_row_text.
+
+    The point stays in the same column, at the same offset from the start of
+    its text.
+
+    """
+    preceding_text = row_text[:col]
+    pipes_num = preceding_text.count("|")
+    if pipes_num == 0:
+        return min(col, len(new_row_text))
+
+    col_start = preceding_text.rfind("|") + 1
+    col_text = row_text[col_start:].split("|", 1)[0]
+    indent = len(col_text) - len(col_text.lstrip())
+    offset = max(col - col_start - indent, 0)
+
+    pipe = -1
+    for i in range(pipes_num):
+        pipe = new_row_text.find("|", pipe + 1)
+        if pipe < 0:
+            return len(new_row_text)
+    next_pipe = new_row_text.find("|", pipe + 1)
+    col_end = next_pipe - 1 if next_pipe >= 0 else len(new_row_text)
+    return max(min(pipe + 2 + offset, col_end), pipe + 1)
 
 
 def _convert_row_text_as_list(row_text):
@@ -116,21 +275,17 @@ def reformat_table_list(table):
     """
     cols_num = max([len(row) for row in table])
     cols_length = _get_cols_length(table, cols_num)
+    empty_row = [" " * col_length for col_length in cols_length]
 
     new_table = []
     for row in table:
-        new_row = []
         if not SEPARATOR_PATTERN.match(row[0]):
-            for i in range(cols_num):
-                try:
-                    col = row[i]
-                    new_row.append(col + " " * (cols_length[i] - len(col)))
-                except:
-                    new_row.append(" " * cols_length[i])
+            new_row = [col.ljust(col_length)
+                       for (col, col_length) in zip(row, cols_length)]
+            new_row.extend(empty_row[len(row):])
         else:
             marker = row[0][1]
-            for i in range(cols_num):
-                new_row.append(marker * (cols_length[i] + 2))
+            new_row = [marker * (col_length + 2) for col_length in cols_length]
             # Add a mark for recognization
             new_row[0] = "+" + new_row[0]
         new_table.append(new_row)
@@ -141,20 +296,14 @@ def convert_table_list_to_str(table):
     """Convert the python list to str for outputing.
 
     """
-    table_str = ""
-    table = copy.deepcopy(table)
+    lines = []
     for row in table:
         if SEPARATOR_PATTERN.match(row[0]):
-            row[0] = row[0][1:]  # Remove the mark added in reformat_table_list
-            row_str = "+"
-            for col_str in row:
-                row_str += col_str + "+"
+            # Remove the mark added in reformat_table_list
+            lines.append("+" + "+".join([row[0][1:]] + row[1:]) + "+")
         else:
-            row_str = "|"
-            for col_str in row:
-                row_str += " " + col_str + " " + "|"
-        table_str += row_str + "\n"
-    return table_str[:-1]
+            lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
 
 
 def _get_cols_length(table, cols_num):
@@ -169,39 +318,113 @@ def _get_cols_length(table, cols_num):
     return cols_length
 
 
-def get_point_row_and_col(view, from_point):
-    """Return the row and col the current point is in the table.
+def insert_column(table, col_num):
+    """Return the table list with an empty column inserted at col_num.
+
+    Separators are left as they are, reformat_table_list makes them fit.
+
     """
-    line_num, _ = view.rowcol(from_point)
-    line_num -= 1
+    new_table = []
+    for row in table:
+        if SEPARATOR_PATTERN.match(row[0]):
+            new_table.append(row)
+        else:
+            row = row + [""] * (col_num - len(row))
+            new_table.append(row[:col_num] + [""] + row[col_num:])
+    return new_table
+
+
+def delete_column(table, col_num):
+    """Return the table list without the column col_num.
+    """
+    new_table = []
+    for row in table:
+        if SEPARATOR_PATTERN.match(row[0]):
+            new_table.append(row)
+        else:
+            new_table.append(row[:col_num] + row[col_num + 1:] or [""])
+    return new_table
 
-    line_text = utilities.text_at_line(view, line_num)
-    row_num = 0
-    while line_text and (TABLE_PATTERN.match(line_text) or
-                         SEPARATOR_PATTERN.match(line_text)):
-        row_num += 1
-        line_num -= 1
-        line_text = utilities.text_at_line(view, line_num)
 
-    line_start_point = view.line(from_point)
-    region = sublime.Region(line_start_point.a, from_point)
-    precedding_text = view.substr(region)
+def move_column(table, col_num, forward=True):
+    """Return the table list with the column col_num swapped with the next
+    (or previous) one, or None if there is no such column.
+    """
+    other_col_num = col_num + 1 if forward else col_num - 1
+    cols_num = max([len(row) for row in table])
+    if not (0 <= col_num < cols_num and 0 <= other_col_num < cols_num):
+        return None
 
-    split_row = precedding_text.split("|")
+    new_table = []
+    for row in table:
+        if not SEPARATOR_PATTERN.match(row[0]):
+            row = row + [""] * (cols_num - len(row))
+            row[col_num], row[other_col_num] = row[other_col_num], row[col_num]
+        new_table.append(row)
+    return new_table
+
+
+def move_row(table, row_num, forward=True):
+    """Return the table list with the row row_num swapped with the next
+    (or previous) one, or None if there is no such row.
+
+    A row never crosses a separator, as in sort_rows: it moves between the
+    separators around it, so it can't leave the table through its borders
+    nor get in or out of the header. Separators don't move either.
+
+    """
+    other_row_num = row_num + 1 if forward else row_num - 1
+    if not (0 <= row_num < len(table) and 0 <= other_row_num < len(table)):
+        return None
+    if SEPARATOR_PATTERN.match(table[row_num][0]) or \
+            SEPARATOR_PATTERN.match(table[other_row_num][0]):
+        return None
+
+    new_table = list(table)
+    new_table[row_num] = table[other_row_num]
+    new_table[other_row_num] = table[row_num]
+    return new_table
+
+
+def sort_rows(table, col_num, reverse=False):
+    """Return the table list with its rows sorted by the column col_num.
+
+    The separators stay in place and the rows are sorted between them, so
+    that the header stays on top. The rows are compared as numbers when all
+    the cells of the column between two separators are numbers, as
+    case-insensitive text otherwise.
+
+    """
+    new_table = []
+    rows = []
+    for row in table + [None]:
+        if row is not None and not SEPARATOR_PATTERN.match(row[0]):
+            rows.append(row)
+            continue
+
+        cells = [r[col_num] if col_num < len(r) else "" for r in rows]
+        try:
+            keys = [float(cell) for cell in cells]
+        except ValueError:
+            keys = [cell.lower() for cell in cells]
+        order = sorted(range(len(rows)), key=keys.__getitem__,
+                       reverse=reverse)
+        new_table.extend([rows[i] for i in order])
+        rows = []
+        if row is not None:
+            new_table.append(row)
+    return new_table
+
+
+def _get_col_num(preceding_text):
+    """Return the col of a point, given the text of its line before it.
+    """
+    split_row = preceding_text.split("|")
     if len(split_row) >= 2:
         col_num = len(split_row) - 2
     elif split_row[0].strip() == "":
         col_num = -1
     else:
         col_num = None
-    return (row_num, col_num)
+    return col_num
 
-
-def is_line_separator(view, line_num):
-    """Check if the current line is a separator.
-    """
-    text = utilities.text_at_line(view, line_num)
-    if text and SEPARATOR_PATTERN.match(text):
-        return True
-    else:
-        return False
@@ -1,23 +1,123 @@
 """Some utility functions for working with sublime.
 """
+import re
+import bisect
 
+import sublime
+
+# A line opening or closing a fenced code block: the fence and what follows.
+FENCE_PATTERN = re.compile(r'[ ]{0,3}(`{3,}|~{3,})(.*)')
+
+# Size of the first chunk read by lines_above, doubled for every following
+# chunk.
+_BACKWARD_CHUNK_SIZE = 4096
 
-def text_at_line(view, line_num):
-    """Return the content at line. None if out of boundary."""
-    if line_num < 0:
-        return None
 
-    max_line_num, _ = view.rowcol(view.size())
-    if line_num > max_line_num:
+def next_fence(fence, marker, info):
+    """Return the fence of the code block open after a fence line.
+
+    fence is the one of the code block open before the line (None if there
+    is none), marker and info the groups of FENCE_PATTERN for the line.
+
+    """
+    if fence is None:
+        # An info string with backticks makes it inline code instead.
+        if marker[0] == '`' and '`' in info:
+            return None
+        return marker
+    if marker[0] == fence[0] and len(marker) >= len(fence) and \
+            not info.strip():
         return None
+    return fence
+
+
+def lines_above(view, point, accept):
+    """Return the lines right above point for which accept is true.
+
+    The last line returned is the text of the line of point before it, and
+    the others the lines above it, up to the first one rejected by accept.
+    The text is read backward in chunks of growing size, so that the cost
+    depends on the lines returned rather than on the position of point.
+
+    """
+    chunk_size = _BACKWARD_CHUNK_SIZE
+    while True:
+        start = max(point - chunk_size, 0)
+        lines = view.substr(sublime.Region(start, point)).split("\n")
+        # The first line might be cut by the chunk, it only counts when the
+        # chunk starts the buffer.
+        first = 0 if start == 0 else 1
+        index = len(lines) - 1
+        while index > first and accept(lines[index - 1]):
+            index -= 1
+        if index > first or start == 0:
+            return lines[index:]
+        chunk_size *= 2
 
-    point = view.text_point(line_num, 0)
-    line_region = view.line(point)
-    return view.substr(line_region)
 
 def is_region_void(region):
     if region == None:
         return True
     if region.a == -1 and region.b == -1:
         return True
-    return False
\ No newline at end of file
+    return False
+
+
+class FoldedRegions(object):
+    """A sorted snapshot of folded regions, answering containment by bisect.
+
+    Take the snapshot once per command with FoldedRegions.of_view, and a
+    new one after folding or unfolding.
+
+    """
+    def __init__(self, regions):
+        self.regions = sorted((r.begin(), r.end()) for r in regions)
+        self.starts = [a for a, _ in self.regions]
+        # The max end among the regions so far, in case some are nested.
+        self.max_ends = []
+        max_end = -1
+        for _, b in self.regions:
+            max_end = max(max_end, b)
+            self.max_ends.append(max_end)
+
+    @classmethod
+    def of_view(cls, view):
+        return cls(view.folded_regions())
+
+    def contains(self, region):
+        """Check if the region (or point) is inside a folded region."""
+        return self.fold_end(region) is not None
+
+    def fold_end(self, region):
+        """Return the end of the folded region containing the region (or
+        point), None if it's not folded.
+
+        """
+        if hasattr(region, 'begin'):
+            a, b = region.begin(), region.end()
+        else:
+            a = b = region
+        index = bisect.bisect_right(self.starts, a) - 1
+        if index >= 0 and self.max_ends[index] >= b:
+            return self.max_ends[index]
+        return None
+
+    def contains_all(self, regions):
+        """Check if all the regions, sorted by position, are folded.
+
+        Empty regions are treated as folded. The regions and the folded
+        regions are swept together once, stopping at the first region which
+        isn't folded.
+
+        """
+        index = 0
+        count = len(self.regions)
+        for region in regions:
+            a, b = region.begin(), region.end()
+            if a == b:
+                continue
+            while index < count and self.max_ends[index] < b:
+                index += 1
+            if index == count or self.starts[index] > a:
+                return False
+        return True